@@ -44,6 +44,10 @@ class ModelArgs:
         self.flash_attention = config.get("flash_attention")
         assert isinstance(self.flash_attention, bool), "flash_attention must be a boolean."
 
+        self.num_heads = config.get("num_heads", 8)
+        assert isinstance(self.num_heads, int), "num_heads must be an integer."
+        assert self.dim_model % self.num_heads == 0, "dim_model must be divisible by num_heads."
+
     def __repr__(self):
         return (f"ModelArgs(\n" +
                 f"model_type={self.model_type},\n" +
@@ -53,5 +57,6 @@ class ModelArgs:
                 f"num_layers={self.num_layers},\n" +
                 f"dropout={self.dropout},\n" +
                 f"maxlen={self.maxlen},\n" +
-                f"flash_attention={self.flash_attention}\n" +
+                f"flash_attention={self.flash_attention},\n" +
+                f"num_heads={self.num_heads}\n" +
                 ")")
\ No newline at end of file
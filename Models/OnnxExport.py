@@ -0,0 +1,170 @@
+import os
+import copy
+import inspect
+import torch
+from torch import nn
+from Models.FlashAttention import SDPA_TransformerEncoder, SDPA_TransformerDecoder
+
+## ONNX export of the incremental inference interface (encode / decode_step) as two graphs:
+##   <run_name>_encoder.onnx      source -> decoding state tensors
+##   <run_name>_decoder_step.onnx last_tokens + state tensors -> logits + new_<state> tensors
+## State tensors are explicit graph inputs/outputs, so a runtime only needs to feed the outputs
+## of the encoder graph (and the new_* outputs of every step) back into the decoder-step graph.
+
+## dynamic axes of every state tensor, per model class
+STATE_AXES = {
+    'Seq2seq_no_attention': {'hidden': {1: 'batch'}},
+    'Seq2seq_with_attention': {'encoder_output': {0: 'batch', 1: 'src_len'},
+                               'encoder_keys': {0: 'batch', 1: 'src_len'},
+                               'src_pad_mask': {0: 'batch', 1: 'src_len'},
+                               'hidden': {1: 'batch'}},
+    'NMT_Transformer': {'cross_k': {1: 'batch', 3: 'src_len'},
+                        'cross_v': {1: 'batch', 3: 'src_len'},
+                        'memory_attn_mask': {0: 'batch', 3: 'src_len'},
+                        'self_k': {1: 'batch', 3: 'past_len'},
+                        'self_v': {1: 'batch', 3: 'past_len'},
+                        'self_attn_mask': {0: 'batch', 3: 'past_len'},
+                        'step': {}},
+}
+## state tensors changed by a decoder step (returned as new_<name>)
+UPDATED_STATE = {
+    'Seq2seq_no_attention': ['hidden'],
+    'Seq2seq_with_attention': ['hidden'],
+    'NMT_Transformer': ['self_k', 'self_v', 'self_attn_mask', 'step'],
+}
+
+
+def _flatten_state(model, state):
+    if model.__class__.__name__ != 'NMT_Transformer':
+        return state
+    layers = state['layers']
+    cross_k = torch.stack([layer['cross_k'] for layer in layers]) # (num_layers, B, nh, Ts, hd)
+    cross_v = torch.stack([layer['cross_v'] for layer in layers])
+    if state['self_attn_mask'] is None:
+        ## nothing decoded yet: empty self-attention cache
+        self_k, self_v = cross_k[:, :, :, :0], cross_v[:, :, :, :0]
+        self_attn_mask = state['memory_attn_mask'][..., :0]
+    else:
+        self_k = torch.stack([layer['self_k'] for layer in layers])
+        self_v = torch.stack([layer['self_v'] for layer in layers])
+        self_attn_mask = state['self_attn_mask']
+    step = state['step']
+    if not torch.is_tensor(step):
+        step = torch.tensor([step], dtype=torch.long, device=cross_k.device)
+    return {'cross_k': cross_k, 'cross_v': cross_v, 'memory_attn_mask': state['memory_attn_mask'],
+            'self_k': self_k, 'self_v': self_v, 'self_attn_mask': self_attn_mask, 'step': step}
+
+
+def _unflatten_state(model, tensors, pad_tokenId):
+    if model.__class__.__name__ != 'NMT_Transformer':
+        return dict(tensors)
+    layers = [{'self_k': self_k, 'self_v': self_v, 'cross_k': cross_k, 'cross_v': cross_v}
+              for self_k, self_v, cross_k, cross_v in zip(tensors['self_k'].unbind(0), tensors['self_v'].unbind(0),
+                                                          tensors['cross_k'].unbind(0), tensors['cross_v'].unbind(0))]
+    return {'layers': layers, 'memory_attn_mask': tensors['memory_attn_mask'],
+            'self_attn_mask': tensors['self_attn_mask'], 'step': tensors['step'], 'pad_tokenId': pad_tokenId}
+
+
+def _with_sdpa_blocks(model):
+    ## nn.MultiheadAttention bakes the traced batch/length into its head reshapes,
+    ## the scaled_dot_product_attention blocks share its state dict layout and trace with dynamic shapes
+    if isinstance(model.transformer_encoder, SDPA_TransformerEncoder):
+        return model
+    layer = model.transformer_encoder.layers[0]
+    block_kwargs = dict(d_model=layer.linear1.in_features, nhead=layer.self_attn.num_heads,
+                        dim_feedforward=layer.linear1.out_features, dropout=layer.dropout.p,
+                        num_layers=len(model.transformer_encoder.layers))
+    sdpa_model = copy.deepcopy(model)
+    sdpa_model.transformer_encoder = SDPA_TransformerEncoder(**block_kwargs)
+    sdpa_model.transformer_decoder = SDPA_TransformerDecoder(**block_kwargs)
+    sdpa_model.load_state_dict(model.state_dict())
+    return sdpa_model.to(next(model.parameters()).device)
+
+
+class EncoderGraph(nn.Module):
+    def __init__(self, model, pad_tokenId):
+        super().__init__()
+        self.model = model
+        self.pad_tokenId = pad_tokenId
+        self.state_names = list(STATE_AXES[model.__class__.__name__])
+
+    def forward(self, source):
+        state = _flatten_state(self.model, self.model.encode(source, self.pad_tokenId))
+        return tuple(state[name] for name in self.state_names)
+
+
+class DecoderStepGraph(nn.Module):
+    def __init__(self, model, pad_tokenId):
+        super().__init__()
+        self.model = model
+        self.pad_tokenId = pad_tokenId
+        self.state_names = list(STATE_AXES[model.__class__.__name__])
+        self.updated_names = UPDATED_STATE[model.__class__.__name__]
+
+    def forward(self, last_tokens, *state_tensors):
+        state = _unflatten_state(self.model, dict(zip(self.state_names, state_tensors)), self.pad_tokenId)
+        logits, state = self.model.decode_step(state, last_tokens)
+        state = _flatten_state(self.model, state)
+        return (logits,) + tuple(state[name] for name in self.updated_names)
+
+
+def _export(module, args, path, input_names, output_names, dynamic_axes, opset_version):
+    kwargs = dict(input_names=input_names, output_names=output_names,
+                  dynamic_axes=dynamic_axes, opset_version=opset_version)
+    ## the TorchScript based exporter handles the packed GRU encoders, newer torch defaults to the dynamo one
+    if 'dynamo' in inspect.signature(torch.onnx.export).parameters: kwargs['dynamo'] = False
+    torch.onnx.export(module, args, path, **kwargs)
+
+
+def export_onnx(model:nn.Module, save_dir:str, run_name:str, pad_tokenId:int, opset_version=17):
+    """
+    Export the encoder and a single decoder step of model as two ONNX graphs with dynamic batch/length axes.
+
+    A transformer built on the stock nn.Transformer* blocks is exported through an equivalent
+    copy on the scaled_dot_product_attention blocks (same weights).
+
+    Returns:
+        Tuple[str, str]: Paths of the encoder graph and of the decoder-step graph.
+    """
+    source_model = getattr(model, '_orig_mod', model) # unwrap torch.compile
+    was_training = source_model.training
+    model = source_model.eval()
+    model_name = model.__class__.__name__
+    assert model_name in STATE_AXES, f"ONNX export is not supported for {model_name}."
+    if model_name == 'NMT_Transformer':
+        model = _with_sdpa_blocks(model).eval()
+    state_axes = STATE_AXES[model_name]
+    state_names = list(state_axes)
+    updated_names = UPDATED_STATE[model_name]
+    device = next(model.parameters()).device
+
+    encoder_graph = EncoderGraph(model, pad_tokenId).eval()
+    decoder_graph = DecoderStepGraph(model, pad_tokenId).eval()
+
+    vocab_size = model.classifier.out_features
+    dummy_source = torch.full((2, 5), (pad_tokenId + 1) % vocab_size, dtype=torch.long, device=device)
+    dummy_source[1, 3:] = pad_tokenId
+    dummy_tokens = torch.full((2, 1), (pad_tokenId + 1) % vocab_size, dtype=torch.long, device=device)
+    ## trace the decoder step with a non-empty past so no cache length gets specialized
+    with torch.no_grad():
+        state = model.encode(dummy_source, pad_tokenId)
+        _, state = model.decode_step(state, dummy_tokens)
+        dummy_state = _flatten_state(model, state)
+
+    encoder_path = os.path.join(save_dir, f"{run_name}_encoder.onnx")
+    _export(encoder_graph, (dummy_source,), encoder_path,
+            input_names=['source'], output_names=state_names,
+            dynamic_axes={'source': {0: 'batch', 1: 'src_len'}, **state_axes},
+            opset_version=opset_version)
+
+    decoder_path = os.path.join(save_dir, f"{run_name}_decoder_step.onnx")
+    new_axes = {f'new_{name}': {dim: ('new_len' if axis == 'past_len' else axis) for dim, axis in state_axes[name].items()}
+                for name in updated_names}
+    _export(decoder_graph, (dummy_tokens,) + tuple(dummy_state[name] for name in state_names), decoder_path,
+            input_names=['last_tokens'] + state_names,
+            output_names=['logits'] + [f'new_{name}' for name in updated_names],
+            dynamic_axes={'last_tokens': {0: 'batch'}, 'logits': {0: 'batch'}, **state_axes, **new_axes},
+            opset_version=opset_version)
+
+    source_model.train(was_training)
+    return encoder_path, decoder_path
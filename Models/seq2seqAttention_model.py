@@ -1,6 +1,8 @@
 import torch
 from torch import nn
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
 import random
+from Models.ChunkedLoss import chunked_cross_entropy
 
 
 class Encoder(nn.Module):
@@ -20,10 +22,19 @@ class Encoder(nn.Module):
                                         nn.ReLU(),
                                         nn.Linear(dim_feedforward, dim_hidden),
                                         nn.Dropout(dropout_probability))
+        ## set to True when batches are already sorted by descending source length
+        ## to skip the sort/unsort done by pack_padded_sequence
+        self.enforce_sorted = False
 
-    def forward(self, x):
+    def forward(self, x, pad_tokenId, lengths=None):
         embds = self.dropout(self.embd_layer(x))
-        context, hidden = self.rnn(embds)
+        ## pack the right-padded batch so the GRU never steps over <pad> tokens
+        ## lengths (CPU) given by the collator avoid a device->host sync here
+        if lengths is None: lengths = (x != pad_tokenId).sum(dim=1).cpu()
+        lengths = lengths.clamp(min=1)
+        packed = pack_padded_sequence(embds, lengths, batch_first=True, enforce_sorted=self.enforce_sorted)
+        context, hidden = self.rnn(packed)
+        context, _ = pad_packed_sequence(context, batch_first=True, total_length=x.size(1)) ## zeros at <pad> positions
         last_hidden = torch.cat([hidden[-2,:,:], hidden[-1,:,:]], dim=-1)
         to_decoder_hidden = self.hidden_map(last_hidden)
         to_decoder_output = self.output_map(context)
@@ -37,15 +48,24 @@ class Attention(nn.Module):
         self.fc_energy = nn.Linear(input_dims*2, input_dims)
         self.alpha = nn.Linear(input_dims, 1, bias=False)
 
+    def project_keys(self, encoder_output): # (B,T,encoder_hidden)
+        ## fc_energy(cat(decoder_hidden, encoder_output)) == W_d @ decoder_hidden + (W_e @ encoder_output + b),
+        ## the encoder half does not change between decoder steps so it is computed once per sentence.
+        input_dims = encoder_output.size(-1)
+        return nn.functional.linear(encoder_output, self.fc_energy.weight[:, input_dims:], self.fc_energy.bias) ## (B,T,input_dims)
+
     def forward(self,
-                encoder_output, # (B,T,encoder_hidden)
-                decoder_hidden): # (B,decoder_hidden)
+                encoder_keys, # (B,T,input_dims) from project_keys
+                decoder_hidden, # (B,decoder_hidden)
+                src_pad_mask=None): # (B,T) True at <pad> positions
         ## encoder_hidden = encoder_hidden = input_dims
 
-        seq_len = encoder_output.size(1)
-        decoder_hidden = decoder_hidden.unsqueeze(1).repeat(1, seq_len, 1) ## (B,T,input_dims)
-        energy = self.fc_energy(torch.cat((decoder_hidden, encoder_output), dim=-1))
+        input_dims = decoder_hidden.size(-1)
+        query = nn.functional.linear(decoder_hidden, self.fc_energy.weight[:, :input_dims]) ## (B,input_dims)
+        energy = encoder_keys + query.unsqueeze(1) ## (B,T,input_dims)
         alphas = self.alpha(energy).squeeze(-1)
+        if src_pad_mask is not None:
+            alphas = alphas.masked_fill(src_pad_mask, float('-inf'))
 
         return torch.softmax(alphas, dim=-1)
 
@@ -58,13 +78,14 @@ class Decoder(nn.Module):
         self.embd_layer = nn.Embedding(vocab_size, dim_embed)
         self.rnn = nn.GRU(dim_hidden + dim_embed, dim_hidden, batch_first=True, num_layers=num_layers, dropout=dropout_probability)
 
-    def forward(self, x, encoder_output, hidden_t_1):
+    def forward(self, x, encoder_output, encoder_keys, hidden_t_1, src_pad_mask=None):
         ## hidden_t_1 shape: (num_layers,B,dim_hidden)
         ## encoder_output shape : (B,T,dim_hidden)
+        ## encoder_keys shape : (B,T,dim_hidden) precomputed by attention.project_keys
         ## x shape: (B,1) one token
 
         embds = self.embd_layer(x) ## (B,1,dim_embed)
-        alphas = self.attention(encoder_output, hidden_t_1[-1]).unsqueeze(1) ## (B,1,T)
+        alphas = self.attention(encoder_keys, hidden_t_1[-1], src_pad_mask).unsqueeze(1) ## (B,1,T)
         attention = torch.bmm(alphas, encoder_output) ## (B,T,dim_embed)
         rnn_input = torch.cat((embds, attention), dim=-1) ## (B,1,dim_hidden + dim_embed)
 
@@ -87,37 +108,52 @@ class Seq2seq_with_attention(nn.Module):
         self.encoder.embd_layer.weight = self.classifier.weight
         self.decoder.embd_layer.weight = self.classifier.weight
 
-    def forward(self, source, target, pad_tokenId):
+    def forward(self, source, target, pad_tokenId, loss_chunk_size=0,
+                source_lengths=None, src_pad_mask=None, trg_pad_mask=None):
         # target = <s> text </s>
         # teacher_force_ratio = 0.5
+        # loss_chunk_size > 0: only the loss is computed (chunked), logits are returned as None
+        # source_lengths / pad masks: optional, precomputed by MyCollate (trg_pad_mask is not needed here)
         B, T = target.size()
-        total_logits = torch.zeros(B, T, self.vocab_size, device=source.device)
-        context, hidden = self.encoder(source)
+        outs = []
+        context, hidden = self.encoder(source, pad_tokenId, source_lengths)
         hidden = hidden.unsqueeze(0).repeat(self.num_layers,1,1) # (numlayer, B, dim_model)
+        keys = self.attention.project_keys(context)
+        if src_pad_mask is None: src_pad_mask = source == pad_tokenId
         for step in range(T):
             step_token = target[:, [step]]
-            out, hidden, alphas = self.decoder(step_token, context, hidden)
-            logits = self.classifier(out).squeeze(1)
-            total_logits[:, step] = logits
+            out, hidden, alphas = self.decoder(step_token, context, keys, hidden, src_pad_mask)
+            outs.append(out)
+        outs = torch.cat(outs, dim=1) # (B,T,dim_model)
+        if loss_chunk_size and T > 1:
+            loss = chunked_cross_entropy(outs[:,:-1], self.classifier, target[:,1:], pad_tokenId, loss_chunk_size)
+            return None, loss
+        total_logits = self.classifier(outs) # (B,T,vocab_size)
         loss = None
         if T > 1:
             flat_logits = total_logits[:,:-1,:].reshape(-1, total_logits.size(-1))
             flat_targets = target[:,1:].reshape(-1)
             loss = nn.functional.cross_entropy(flat_logits, flat_targets, ignore_index=pad_tokenId)
         return total_logits, loss
-    
-    @torch.no_grad
-    def greedy_decode_fast(self, source:torch.Tensor, sos_tokenId: int, eos_tokenId:int, pad_tokenId, max_tries=50):
-        self.eval()
-        targets_hat = [sos_tokenId]
-        context, hidden = self.encoder(source.unsqueeze(0))
+
+    def encode(self, source, pad_tokenId):
+        ## Runs the encoder once and returns the incremental decoding state
+        context, hidden = self.encoder(source, pad_tokenId)
         hidden = hidden.unsqueeze(0).repeat(self.num_layers,1,1) # (numlayer, B, dim_model)
-        for step in range(max_tries):
-            x = torch.tensor([targets_hat[step]]).unsqueeze(0).to(source.device)
-            out, hidden, alphas = self.decoder(x, context, hidden)
-            logits = self.classifier(out)
-            top1 = logits.argmax(-1)
-            targets_hat.append(top1.item())
-            if top1 == eos_tokenId:
-                return targets_hat
-        return targets_hat
+        return {'encoder_output': context,
+                'encoder_keys': self.attention.project_keys(context),
+                'src_pad_mask': source == pad_tokenId,
+                'hidden': hidden}
+
+    def decode_step(self, state, last_tokens):
+        ## last_tokens shape: (B, 1), returns logits of shape (B, vocab_size) and the updated state
+        out, hidden, alphas = self.decoder(last_tokens, state['encoder_output'], state['encoder_keys'],
+                                           state['hidden'], state['src_pad_mask'])
+        return self.classifier(out).squeeze(1), {**state, 'hidden': hidden}
+
+    def reorder_state(self, state, index):
+        ## Selects/repeats batch rows of the state (used to expand and reorder beams)
+        return {'encoder_output': state['encoder_output'].index_select(0, index),
+                'encoder_keys': state['encoder_keys'].index_select(0, index),
+                'src_pad_mask': state['src_pad_mask'].index_select(0, index),
+                'hidden': state['hidden'].index_select(1, index)}
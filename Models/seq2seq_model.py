@@ -1,6 +1,8 @@
 import torch
 from torch import nn
+from torch.nn.utils.rnn import pack_padded_sequence
 import random
+from Models.ChunkedLoss import chunked_cross_entropy
 
 
 class Encoder(nn.Module):
@@ -16,10 +18,18 @@ class Encoder(nn.Module):
                                 nn.ReLU(),
                                 nn.Linear(dim_feedforward, dim_hidden),
                                 nn.Dropout(dropout_probability))
+        ## set to True when batches are already sorted by descending source length
+        ## to skip the sort/unsort done by pack_padded_sequence
+        self.enforce_sorted = False
 
-    def forward(self, x):
+    def forward(self, x, pad_tokenId, lengths=None):
         embds = self.dropout(self.embd_layer(x))
-        output, hidden = self.rnn(embds)
+        ## pack the right-padded batch so the GRU never steps over <pad> tokens
+        ## lengths (CPU) given by the collator avoid a device->host sync here
+        if lengths is None: lengths = (x != pad_tokenId).sum(dim=1).cpu()
+        lengths = lengths.clamp(min=1)
+        packed = pack_padded_sequence(embds, lengths, batch_first=True, enforce_sorted=self.enforce_sorted)
+        output, hidden = self.rnn(packed)
         ## hidden[-2,:,:]: hidden state for the forward direction of the last layer.
         ## hidden[-1,:,:]: hidden state for the backward direction of the last layer.
         last_hidden = torch.cat([hidden[-2,:,:], hidden[-1,:,:]], dim=-1)
@@ -39,9 +49,11 @@ class Decoder(nn.Module):
         self.ffw = nn.Linear(dim_hidden, dim_hidden)
         
     def forward(self, x, hidden_t_1):
+        ## x shape: (B,T) works for one token (T=1) or a whole teacher-forced target at once
         embds = self.dropout(self.embd_layer(x))
         output, hidden_t = self.rnn(embds, hidden_t_1)
-        out = self.ffw(hidden_t[-1])
+        ## output holds the last layer hidden state of every step
+        out = self.ffw(output) ## (B,T,dim_hidden)
         return out, hidden_t
 
 
@@ -57,40 +69,40 @@ class Seq2seq_no_attention(nn.Module):
         self.encoder.embd_layer.weight = self.classifier.weight
         self.decoder.embd_layer.weight = self.classifier.weight
 
-    def forward(self, source, target, pad_tokenId):
+    def forward(self, source, target, pad_tokenId, loss_chunk_size=0,
+                source_lengths=None, src_pad_mask=None, trg_pad_mask=None):
         # target = <s> text </s>
+        # loss_chunk_size > 0: only the loss is computed (chunked), logits are returned as None
+        # source_lengths / pad masks: optional, precomputed by MyCollate (pad masks are not needed here)
         # teacher_force_ratio = 0.5
         B, T = target.size()
-        total_logits = torch.zeros(B, T, self.vocab_size, device=source.device) # (B,T,vocab_size)
 
-        context = self.encoder(source) # (B, dim_model)
+        context = self.encoder(source, pad_tokenId, source_lengths) # (B, dim_model)
         ## We will pass the hiddens for each layer of the decoder (inspired by Attention is all you need paper)
         context = context.unsqueeze(0).repeat(self.num_layers,1,1) # (numlayer, B, dim_model)
-        for step in range(T):
-            step_token = target[:, [step]]
-            out, context = self.decoder(step_token, context)
-            logits = self.classifier(out).squeeze(1)
-            total_logits[:, step] = logits
+        ## Full teacher forcing: the whole target goes through the decoder GRU in one call
+        out, _ = self.decoder(target, context)
+        if loss_chunk_size and T > 1:
+            loss = chunked_cross_entropy(out[:,:-1], self.classifier, target[:,1:], pad_tokenId, loss_chunk_size)
+            return None, loss
+        total_logits = self.classifier(out) # (B,T,vocab_size)
         loss = None
         if T > 1:
             flat_logits = total_logits[:,:-1,:].reshape(-1, total_logits.size(-1))
             flat_targets = target[:,1:].reshape(-1)
             loss = nn.functional.cross_entropy(flat_logits, flat_targets, ignore_index=pad_tokenId)
         return total_logits, loss
-    
-    
-    @torch.no_grad
-    def greedy_decode_fast(self, source:torch.Tensor, sos_tokenId: int, eos_tokenId:int, pad_tokenId, max_tries=50):
-        self.eval()
-        targets_hat = [sos_tokenId]
-        context = self.encoder(source.unsqueeze(0))
-        context = context.unsqueeze(0).repeat(self.num_layers,1,1)
-        for step in range(max_tries):
-            x = torch.tensor([targets_hat[step]]).unsqueeze(0).to(source.device)
-            out, context = self.decoder(x, context)
-            logits = self.classifier(out)
-            top1 = logits.argmax(-1)
-            targets_hat.append(top1.item())
-            if top1 == eos_tokenId:
-                return targets_hat
-        return targets_hat
\ No newline at end of file
+
+    def encode(self, source, pad_tokenId):
+        ## Runs the encoder once and returns the incremental decoding state
+        context = self.encoder(source, pad_tokenId) # (B, dim_model)
+        return {'hidden': context.unsqueeze(0).repeat(self.num_layers,1,1)} # (numlayer, B, dim_model)
+
+    def decode_step(self, state, last_tokens):
+        ## last_tokens shape: (B, 1), returns logits of shape (B, vocab_size) and the updated state
+        out, hidden = self.decoder(last_tokens, state['hidden'])
+        return self.classifier(out).squeeze(1), {'hidden': hidden}
+
+    def reorder_state(self, state, index):
+        ## Selects/repeats batch rows of the state (used to expand and reorder beams)
+        return {'hidden': state['hidden'].index_select(1, index)}
@@ -1,32 +1,106 @@
 import sentencepiece as spm
+import itertools
+import torch
+import numpy as np
 import pandas as pd
 import os
+import glob
 ## requirements
 # !pip -q install sentencepiece
 ## source is english and traget is arabic.
 
-def train(train_csv_path:str, tokenizer_params:dict, train_on_columns:list, tokenizer_path):
+def data_files(path:str):
+    ## a CSV file, a Parquet file or a directory of Parquet shards (make_data output)
+    if os.path.isdir(path):
+        files = sorted(glob.glob(os.path.join(path, '*.parquet')))
+        assert files, f"{path} : no .parquet shards found."
+        return files
+    return [path]
+
+
+def read_text_chunks(path:str, columns:list, chunk_size=100_000):
+    """
+    Yield DataFrames of the given columns, chunk_size rows at a time, from a CSV file,
+    a Parquet file or a directory of Parquet shards. Parquet is read column-wise:
+    only the requested columns are decoded, without re-parsing text.
+    """
+    for file in data_files(path):
+        if file.endswith('.parquet'):
+            import pyarrow.parquet as pq
+            for batch in pq.ParquetFile(file).iter_batches(batch_size=chunk_size, columns=columns):
+                yield batch.to_pandas()
+        else:
+            yield from pd.read_csv(file, usecols=columns, chunksize=chunk_size)
+
+
+def reservoir_sample(sentences, sample_size:int, seed=0):
+    """
+    Uniform sample of at most sample_size sentences from a stream of chunks (Algorithm R),
+    memory is bounded by sample_size whatever the length of the stream.
+
+    Args:
+        sentences (Iterable[List[str]]): Chunks of sentences.
+        sample_size (int): Maximum number of sentences kept.
+        seed (int): Seed of the sampling. Default is 0.
+
+    Returns:
+        Tuple[List[str], int]: The sampled sentences and the number of sentences seen.
+    """
+    rng = np.random.default_rng(seed)
+    reservoir = []
+    seen = 0
+    for chunk in sentences:
+        fill = min(max(sample_size - len(reservoir), 0), len(chunk))
+        reservoir.extend(chunk[:fill])
+        if fill < len(chunk):
+            ## item number i (0-based in the stream) replaces a random slot with probability sample_size / (i+1)
+            positions = np.arange(seen + fill, seen + len(chunk))
+            slots = rng.integers(0, positions + 1)
+            for i in np.flatnonzero(slots < sample_size):
+                reservoir[slots[i]] = chunk[fill + i]
+        seen += len(chunk)
+    return reservoir, seen
+
+
+def train(train_csv_path:str, tokenizer_params:dict, train_on_columns:list, tokenizer_path, seed=0):
     print("Starting Tokenizer Train...")
 
-    dataframe = pd.read_csv(train_csv_path)[train_on_columns]
-    sentences = []
-    for col in train_on_columns:
-        sentences = sentences + dataframe[col].to_list()
+    ## stream the columns chunk by chunk, keeping a reservoir sample of input_sentence_size sentences
+    ## (SentencePiece would only use that many anyway): memory grows with the corpus up to that cap, then stays flat
+    ## (with the default 200,000,000 of the config, a smaller corpus is held whole, lower the cap to bound it)
+    statics_dict = {col: 0 for col in train_on_columns}
+    def sentence_chunks():
+        for chunk in read_text_chunks(train_csv_path, train_on_columns):
+            for col in train_on_columns:
+                sentences = chunk[col].dropna().to_list()
+                statics_dict[col] += len(sentences)
+                yield sentences
+    sample_size = tokenizer_params.get('input_sentence_size', 0) or np.iinfo(np.int64).max
+    sentences, num_sentences = reservoir_sample(sentence_chunks(), sample_size, seed)
+    print(f"Sampled {len(sentences):,} of {num_sentences:,} sentences")
+
     tokenizer_params['model_prefix'] = os.path.join(tokenizer_path, tokenizer_params['model_prefix'])
+    ## num_threads of the config (and every other key) is passed to the trainer as is
     spm.SentencePieceTrainer.train(sentence_iterator=iter(sentences), **tokenizer_params)
 
     print(f"{tokenizer_params['model_prefix']} Done")
-    statics_dict = {col: len(dataframe[col]) for col in train_on_columns}
     print("Tokenizer Train Done.")
     print(f"Trained on {statics_dict} sentences")
 
 
 ## Tokenizer
 class Callable_tokenizer():
-    def __init__(self, tokenizer_path):
+    def __init__(self, tokenizer_path, num_threads=-1):
         self.path = tokenizer_path
         self.tokenizer = spm.SentencePieceProcessor()
         self.tokenizer.load(tokenizer_path)
+        ## threads of the batch methods, -1 = all cores
+        self.num_threads = num_threads
+        ## special token ids, looked up once
+        self.sos_tokenId = self.get_tokenId('<s>')
+        self.eos_tokenId = self.get_tokenId('</s>')
+        self.pad_tokenId = self.get_tokenId('<pad>')
+
     def __call__(self, text):
         return self.tokenizer.Encode(text)
 
@@ -43,4 +117,47 @@ class Callable_tokenizer():
         return len(self.tokenizer)
 
     def user_tokenization(self, text):
-        return self(text) + [self.get_tokenId('</s>')]
+        return self(text) + [self.eos_tokenId]
+
+    def encode_batch(self, texts:list, add_sos=False, add_eos=False):
+        """
+        Encode a list of sentences with SentencePiece's multi-threaded batch encoding.
+
+        Returns:
+            List[List[int]]: Ragged token ids, one list per sentence.
+        """
+        return self.tokenizer.Encode(texts, add_bos=add_sos, add_eos=add_eos, num_threads=self.num_threads)
+
+    def encode_batch_padded(self, texts:list, add_sos=False, add_eos=False, pad_tokenId=None):
+        """
+        Encode a list of sentences into a right-padded batch.
+
+        Returns:
+            Tuple[torch.Tensor, torch.Tensor]: Token ids (B, T) and lengths (B,), both int64.
+        """
+        tokens_list = self.encode_batch(texts, add_sos=add_sos, add_eos=add_eos)
+        pad_tokenId = self.pad_tokenId if pad_tokenId is None else pad_tokenId
+        lengths = torch.tensor([len(tokens) for tokens in tokens_list], dtype=torch.long)
+        padded = torch.full((len(tokens_list), int(lengths.max()) if len(tokens_list) else 0), pad_tokenId, dtype=torch.long)
+        ## scatter all ids at once through the (B, T) mask of the real positions
+        mask = torch.arange(padded.size(1)) < lengths.unsqueeze(1)
+        padded[mask] = torch.tensor(list(itertools.chain.from_iterable(tokens_list)), dtype=torch.long)
+        return padded, lengths
+
+    def decode_batch(self, tokens_batch, lengths=None):
+        """
+        Decode a batch of token ids with SentencePiece's multi-threaded batch decoding.
+
+        Args:
+            tokens_batch (List[List[int]] | torch.Tensor): Ragged lists or a (B, T) tensor.
+            lengths (torch.Tensor): Optional lengths of the rows of a padded tensor.
+                Without lengths, <pad>, <s> and </s> are dropped by SentencePiece anyway.
+
+        Returns:
+            List[str]: One sentence per row.
+        """
+        if torch.is_tensor(tokens_batch):
+            tokens_batch = tokens_batch.tolist()
+        if lengths is not None:
+            tokens_batch = [tokens[:length] for tokens, length in zip(tokens_batch, lengths.tolist())]
+        return self.tokenizer.Decode(tokens_batch, num_threads=self.num_threads)
@@ -13,9 +13,11 @@ def parse_arguments():
     parser = argparse.ArgumentParser(description='Argument Parser')
 
     parser.add_argument('--out_dir', type=str, required=True, help='A path for output directory')
-    parser.add_argument('--train_csv_path', type=str, required=True, help='CSV of columns "source_lang" and "target_lang" for train')
+    parser.add_argument('--train_csv_path', type=str, required=True, help='CSV (or Parquet file / directory of Parquet shards) of columns "source_lang" and "target_lang" for train')
     parser.add_argument('--train_on_columns', type=str, nargs='+', required=True, help='List of columns to train the tokenizer on')
     parser.add_argument('--config_path', type=str, default=DEFAULT_CONFIG_PATH, help='Path to the config file of the tokenizers')
+    parser.add_argument('--input_sentence_size', type=int, default=None,
+                        help='Maximum number of sampled training sentences (overrides input_sentence_size of the config), bounds the memory')
     # parser.add_argument('--log_path', type=str, default=DEFAULT_LOG_PATH, help='Path to the log file')
     return parser
 
@@ -30,6 +32,9 @@ if __name__ == '__main__':
     os.makedirs(tokenizer_path, exist_ok=True)
     
     tokenizer_params = json.load(open(args.config_path, 'r'))
+    if args.input_sentence_size is not None:
+        assert args.input_sentence_size >= 0, "input_sentence_size must be a non-negative integer."
+        tokenizer_params['input_sentence_size'] = args.input_sentence_size
     Tokenizers.train(train_csv_path=args.train_csv_path,
                      tokenizer_params=tokenizer_params,
                      train_on_columns=args.train_on_columns,
@@ -1,15 +1,24 @@
+import os
+import copy
+import glob
+import numpy as np
 import torch
 from tqdm import tqdm
 from .TrainingArguments import TrainingArguments
-from utils import MT_Dataset, MyCollate, save_checkpoint, CosineScheduler
-from torch.utils.data import DataLoader
+from Tokenizers.Tokenizers import Callable_tokenizer
+from utils import (MT_Dataset, MyCollate, RandomBatchSampler, TokenBudgetBatchSampler, CheckpointWriter,
+                   save_checkpoint, cpu_snapshot, get_rng_states, set_rng_states, CosineScheduler, greedy_decode_batch, beam_search,
+                   TrainingMeter, JsonlLogger)
+from nltk.translate.bleu_score import corpus_bleu, SmoothingFunction
+from torch.utils.data import DataLoader, IterableDataset
+from concurrent.futures import ThreadPoolExecutor
 from collections import defaultdict
 
 
 class Trainer():
     def __init__(self, args:TrainingArguments, model:torch.nn.Module,
                  train_ds:MT_Dataset, valid_ds:MT_Dataset,
-                 collator:MyCollate, compute_metrics_func):
+                 collator:MyCollate, compute_metrics_func, tokenizer:Callable_tokenizer=None):
         
         self.args = args
         self.model = model.to(self.args.device)
@@ -17,35 +26,158 @@ class Trainer():
         self.valid_ds = valid_ds
         self.collator = collator
         self.compute_metrics_func = compute_metrics_func
+        ## needed by the decoding evaluation (eval_decoding != 'none') to detokenize the outputs
+        self.tokenizer = tokenizer
+        assert self.args.eval_decoding == 'none' or self.tokenizer is not None, "eval_decoding needs a tokenizer."
 
         self.generator = torch.manual_seed(self.args.seed) if self.args.seed else None
-        self.train_loader = DataLoader(self.train_ds,
-                                  batch_size=self.args.batch_size,
-                                  shuffle=True,
-                                  collate_fn=self.collator,
-                                  num_workers=self.args.cpu_num_workers,
-                                  generator=self.generator,
-                                  pin_memory=self.args.pin_memory)
-        
-        self.valid_loader = DataLoader(self.valid_ds,
-                                  batch_size=self.args.batch_size,
-                                  shuffle=False,
-                                  collate_fn=self.collator,
-                                  num_workers=self.args.cpu_num_workers,
-                                  generator=self.generator,
-                                  pin_memory=self.args.pin_memory)
+        ## map-style train data goes through a (seed, epoch) batch sampler, so a resumed run can skip to its position
+        self.train_batch_sampler = None
+        if isinstance(self.train_ds, IterableDataset):
+            ## streaming dataset: it shards and shuffles itself, no random access for samplers
+            self.train_loader = DataLoader(self.train_ds,
+                                      batch_size=self.args.batch_size,
+                                      collate_fn=self.collator,
+                                      num_workers=self.args.cpu_num_workers,
+                                      generator=self.generator,
+                                      pin_memory=self.args.pin_memory)
+        elif self.args.max_tokens > 0:
+            ## length-bucketed batches under a padded-token budget instead of a fixed batch_size
+            self.train_batch_sampler = TokenBudgetBatchSampler(*self.train_ds.lengths(),
+                                                               max_tokens=self.args.max_tokens,
+                                                               bucket_width=self.args.bucket_width,
+                                                               shuffle=True,
+                                                               seed=self.args.seed)
+            self.train_loader = DataLoader(self.train_ds,
+                                      batch_sampler=self.train_batch_sampler,
+                                      collate_fn=self.collator,
+                                      num_workers=self.args.cpu_num_workers,
+                                      pin_memory=self.args.pin_memory)
+        else:
+            self.train_batch_sampler = RandomBatchSampler(len(self.train_ds),
+                                                          batch_size=self.args.batch_size,
+                                                          shuffle=True,
+                                                          seed=self.args.seed)
+            self.train_loader = DataLoader(self.train_ds,
+                                      batch_sampler=self.train_batch_sampler,
+                                      collate_fn=self.collator,
+                                      num_workers=self.args.cpu_num_workers,
+                                      pin_memory=self.args.pin_memory)
+
+        ## own generator: iterating the validation set (possibly in the evaluation thread) leaves the global torch RNG alone
+        self.eval_generator = torch.Generator().manual_seed(self.args.seed)
+        ## worker processes can not be forked safely from the evaluation thread, it loads the validation batches itself
+        valid_num_workers = 0 if self.args.async_eval else self.args.cpu_num_workers
+        if self.args.max_tokens > 0:
+            self.valid_loader = DataLoader(self.valid_ds,
+                                      batch_sampler=TokenBudgetBatchSampler(*self.valid_ds.lengths(),
+                                                                            max_tokens=self.args.max_tokens,
+                                                                            bucket_width=self.args.bucket_width,
+                                                                            shuffle=False),
+                                      collate_fn=self.collator,
+                                      num_workers=valid_num_workers,
+                                      generator=self.eval_generator,
+                                      pin_memory=self.args.pin_memory)
+        else:
+            self.valid_loader = DataLoader(self.valid_ds,
+                                      batch_size=self.args.batch_size,
+                                      shuffle=False,
+                                      collate_fn=self.collator,
+                                      num_workers=valid_num_workers,
+                                      generator=self.eval_generator,
+                                      pin_memory=self.args.pin_memory)
         
         self.lr_sch = CosineScheduler(max_steps=args.max_steps,
                                  warmup_steps=args.warmup_steps,
                                  max_lr=args.learning_rate,
                                  min_lr=args.learning_rate*args.lr_decay_ratio)
 
-    def train(self):
+        ## decoding order of the validation subset, computed once and reused by every evaluate_decoding
+        self.valid_decode_order = self._decode_order(self.valid_ds) if self.args.eval_decoding != 'none' else None
+
+        ## resumable checkpoints every save_steps steps, the save_total_limit most recent ones are kept
+        self.checkpoints_dir = os.path.join(self.args.save_models_dir, 'checkpoints')
+        os.makedirs(self.checkpoints_dir, exist_ok=True)
+        self.checkpoint_writer = CheckpointWriter(keep_last=self.args.save_total_limit)
+
+        ## asynchronous evaluation: a copy of the model on eval_device scores weight snapshots in a background thread
+        ## while training goes on, at most one evaluation is in flight
+        self.eval_model = None
+        self.pending_eval = None
+        if self.args.async_eval:
+            self.eval_model = copy.deepcopy(getattr(self.model, '_orig_mod', self.model)).to(self.args.eval_device).eval()
+            self.eval_executor = ThreadPoolExecutor(max_workers=1)
+            self.eval_stream = torch.cuda.Stream(self.args.eval_device) if torch.device(self.args.eval_device).type == 'cuda' else None
+
+    def _to_device(self, data, labels_forward, batch_info, device=None):
+        ## pinned batches are copied asynchronously, source_lengths stays on the CPU for pack_padded_sequence
+        device = self.args.device if device is None else device
+        non_blocking = self.args.pin_memory
+        batch_kwargs = {'source_lengths': batch_info['source_lengths'],
+                        'src_pad_mask': batch_info['src_pad_mask'].to(device, non_blocking=non_blocking),
+                        'trg_pad_mask': batch_info['trg_pad_mask'].to(device, non_blocking=non_blocking)}
+        return (data.to(device, non_blocking=non_blocking),
+                labels_forward.to(device, non_blocking=non_blocking),
+                batch_kwargs)
+
+    def _checkpoint_paths(self):
+        return sorted(glob.glob(os.path.join(self.checkpoints_dir, f"{self.args.run_name}_step-*.pth")))
+
+    def _load_checkpoint(self, resume_from, optimizer):
+        if resume_from == 'latest':
+            checkpoint_paths = self._checkpoint_paths()
+            assert checkpoint_paths, f"{self.checkpoints_dir} : no checkpoint to resume from."
+            resume_from = checkpoint_paths[-1]
+        assert os.path.exists(resume_from), f"{resume_from} : checkpoint not found."
+        state = torch.load(resume_from, map_location='cpu', weights_only=True)
+        assert 'optimizer_state_dict' in state and 'step' in state, f"{resume_from} : not a resumable checkpoint."
+        self.model.load_state_dict(state['model_state_dict'])
+        optimizer.load_state_dict(state['optimizer_state_dict'])
+        print(f"Resuming from {resume_from} at step {state['step']}")
+        return state
+
+    def _start_epoch(self, epoch, skip_batches=0):
+        ## the torch RNG state at the start of the epoch seeds the streaming shuffling (and the workers)
+        epoch_rng_state = torch.get_rng_state()
+        if self.train_batch_sampler is not None:
+            self.train_batch_sampler.set_position(epoch, skip_batches)
+            return iter(self.train_loader), epoch_rng_state
+        train_loader_iter = iter(self.train_loader)
+        ## streaming dataset: no random access, the batches before the position are read again
+        for _ in range(skip_batches):
+            if next(train_loader_iter, None) is None: break
+        return train_loader_iter, epoch_rng_state
+
+    def train(self, resume_from=None):
+        """
+        Train the model for max_steps steps.
 
+        Args:
+            resume_from (str): Checkpoint to resume from (model, optimizer, step, RNG states and position in the train data),
+                a <run_name>_step-*.pth of save_models_dir/checkpoints, the best <run_name>.pth,
+                or 'latest' for the most recent checkpoint of save_models_dir/checkpoints. Default is None (new run).
+
+        Returns:
+            dict: The history of the train loss and validation metrics.
+        """
         print(f"Start Training {self.model.__class__.__name__} model...")
         print(f'AdamW optimizer will be used will learning_rate={self.args.learning_rate}, weight_decay={self.args.weight_decay}')
         optimizer = torch.optim.AdamW(self.model.parameters(), lr=self.args.learning_rate, weight_decay=self.args.weight_decay)
 
+        history = defaultdict(list)
+        # train_losses = []
+        step=0
+        best_valid_bleu = float("-inf")  # Assuming BLEU score is always non-negative
+        ## position in the train data: epoch index and batches drawn from that epoch
+        epoch, epoch_step = 0, 0
+        resume_state = None
+        if resume_from is not None:
+            resume_state = self._load_checkpoint(resume_from, optimizer)
+            history = defaultdict(list, resume_state['history'])
+            step = resume_state['step'] # the lr schedule is a function of the step
+            best_valid_bleu = resume_state['best_valid_bleu']
+            epoch, epoch_step = resume_state['epoch'], resume_state['epoch_step']
+
         if self.args.torch_compile:
             print(f"Compiling the model using torch.compile...")
             self.model = torch.compile(self.model)
@@ -56,113 +188,267 @@ class Trainer():
         else: 
             print("Using TF16")
 
-        history = defaultdict(list)
-        # train_losses = []
-        step=0
-        best_valid_bleu = float("-inf")  # Assuming BLEU score is always non-negative
-        train_loader_iter = iter(self.train_loader)  # Create an iterator for the train_loader
+        if resume_state is not None:
+            torch.set_rng_state(resume_state['epoch_rng_state'])
+        train_loader_iter, epoch_rng_state = self._start_epoch(epoch, epoch_step)  # Create an iterator for the train_loader
+        if resume_state is not None:
+            set_rng_states(resume_state['rng_states'])
+
+        ## step-time / throughput instrumentation: the loss stays on the device and is read every log_steps steps
+        self.metrics_logger = JsonlLogger(self.args.metrics_path, append=resume_state is not None)
+        meter = TrainingMeter(self.args.device)
+        eval_loss_sum, eval_loss_steps = 0.0, 0 # mean train loss between two evaluations
+        if resume_state is not None:
+            eval_loss_sum, eval_loss_steps = resume_state.get('eval_loss', (0.0, 0))
 
-        tqdm_loop = tqdm(total=self.args.max_steps, position=0)
+        tqdm_loop = tqdm(total=self.args.max_steps, initial=step, position=0)
         self.model = self.model.train()  # Set the model to training mode
         while step < self.args.max_steps:
+            meter.start_data()
             try:
                 # Get the next batch
-                data, labels_forward = next(train_loader_iter)
+                data, labels_forward, batch_info = next(train_loader_iter)
             except StopIteration:
                 # Reinitialize the iterator when all batches are consumed
-                train_loader_iter = iter(self.train_loader)
-                data, labels_forward = next(train_loader_iter)
+                epoch, epoch_step = epoch + 1, 0
+                train_loader_iter, epoch_rng_state = self._start_epoch(epoch)
+                data, labels_forward, batch_info = next(train_loader_iter)
+            epoch_step += 1
             # Get data
-            data = data.to(self.args.device)
-            labels_forward = labels_forward.to(self.args.device)
+            data, labels_forward, batch_kwargs = self._to_device(data, labels_forward, batch_info)
+            meter.end_data(data, labels_forward, batch_info)
             
             # Forward
+            meter.mark()
             if self.args.precision == 'high':
                 with torch.autocast(device_type=self.args.device, dtype=torch.bfloat16):
                     logits, loss = self.model(source=data,
                                               target=labels_forward,
-                                              pad_tokenId=self.collator.pad_value)
+                                              pad_tokenId=self.collator.pad_value,
+                                              loss_chunk_size=self.args.loss_chunk_size,
+                                              **batch_kwargs)
             else:
                 logits, loss = self.model(source=data,
                                           target=labels_forward,
-                                          pad_tokenId=self.collator.pad_value)
+                                          pad_tokenId=self.collator.pad_value,
+                                          loss_chunk_size=self.args.loss_chunk_size,
+                                          **batch_kwargs)
+            meter.mark()
 
             # Backward
             optimizer.zero_grad()
             loss.backward()
-            # train_losses.append(loss.item())
             torch.nn.utils.clip_grad_norm_(self.model.parameters(), max_norm=1.0)
+            meter.mark()
 
             curr_lr = self.lr_sch.get_lr(step=step)
             for group in optimizer.param_groups:
                 group['lr'] = curr_lr
             optimizer.step()
+            meter.mark()
+            meter.end_step(loss)
+            eval_loss_sum, eval_loss_steps = eval_loss_sum + loss.detach().float(), eval_loss_steps + 1
 
             # Update step
             step += 1
             tqdm_loop.update(1)
             tqdm_loop.set_description(f"Step [{step}/{self.args.max_steps}]")
-            tqdm_loop.set_postfix_str(f'loss={round(loss.item(), 4)}')
+            if step % self.args.log_steps == 0 or step == self.args.max_steps:
+                record = meter.collect(step, curr_lr) # the only synchronization between evaluations
+                self._record_log(history, record)
+                tqdm_loop.set_postfix_str(f"loss={record['train_loss']}, tok/s={record['tokens_per_sec']:,.0f}, "
+                                          f"data_wait={record['data_wait_ratio']:.0%}")
 
+            ## evaluation and checkpointing are left out of the step times
+            meter.pause()
             if self.args.eval_steps != 0 and self.args.eval_steps is not None:
                 if step % self.args.eval_steps == 0 or step == self.args.max_steps:
-                    # mean_loss = round(sum(train_losses)/len(train_losses), 4)
-                    # train_losses = []
-                    # history['train_loss'].append(mean_loss)
-                    history['train_loss'].append(round(loss.item(), 4))
-                    history['steps'].append(step)
-                    metrics = self.evaluate()
-                    for metric, value in metrics.items():
-                        history[metric].append(value)
-                    print(f'\n  Validation step-{step}: {metrics}')
-                    # Check if the current BLEU score is better than or equal to the best BLEU score
-                    if metrics['valid_bleu'] >= best_valid_bleu:
-                        print(f"    BLEU score improved from {best_valid_bleu} to {metrics['valid_bleu']}")
-                        best_valid_bleu = metrics['valid_bleu']  # Update the best BLEU score
-                        # Save the model checkpoint
-                        save_checkpoint(model=self.model,
-                                        optimizer=optimizer,
-                                        save_dir=self.args.save_models_dir,
-                                        run_name=self.args.run_name,
-                                        in_onnx=self.args.onnx)
-                    self.model = self.model.train()
+                    ## mean train loss since the previous evaluation
+                    train_loss = round(float(eval_loss_sum) / eval_loss_steps, 4)
+                    eval_loss_sum, eval_loss_steps = 0.0, 0
+                    if self.args.async_eval:
+                        ## the previous evaluation is collected first (waits only if it is still running)
+                        best_valid_bleu = self._collect_evaluation(history, best_valid_bleu, wait=True)
+                        self._submit_evaluation(step, train_loss)
+                    else:
+                        metrics = self.evaluate()
+                        best_valid_bleu, improved = self._record_evaluation(history, step, train_loss, metrics, best_valid_bleu)
+                        if improved:
+                            # Save the model checkpoint
+                            save_checkpoint(model=self.model,
+                                            optimizer=optimizer,
+                                            save_dir=self.args.save_models_dir,
+                                            run_name=self.args.run_name,
+                                            in_onnx=self.args.onnx,
+                                            pad_tokenId=self.collator.pad_value,
+                                            training_state=self._training_state(step, epoch, epoch_step, epoch_rng_state,
+                                                                                best_valid_bleu, history),
+                                            writer=self.checkpoint_writer)
+                        self.model = self.model.train()
+
+            if self.args.async_eval:
+                ## results of the evaluation thread are recorded as soon as they are ready
+                best_valid_bleu = self._collect_evaluation(history, best_valid_bleu, wait=False)
+
+            if self.args.save_steps != 0:
+                if step % self.args.save_steps == 0 or step == self.args.max_steps:
+                    ## written in the background, keep-last-N rotation
+                    save_checkpoint(model=self.model,
+                                    optimizer=optimizer,
+                                    save_dir=self.checkpoints_dir,
+                                    run_name=f"{self.args.run_name}_step-{step:08d}",
+                                    training_state=self._training_state(step, epoch, epoch_step, epoch_rng_state,
+                                                                        best_valid_bleu, history,
+                                                                        (float(eval_loss_sum), eval_loss_steps)),
+                                    writer=self.checkpoint_writer,
+                                    rotate_glob=os.path.join(self.checkpoints_dir, f"{self.args.run_name}_step-*.pth"))
+            meter.resume()
 
+        if self.args.async_eval:
+            best_valid_bleu = self._collect_evaluation(history, best_valid_bleu, wait=True)
+        self.checkpoint_writer.wait()
+        self.metrics_logger.close()
         tqdm_loop.close()
         print("Model Training Done.")
         return history
     
 
+    def _record_log(self, history, record):
+        ## TrainingMeter record of a log_steps interval: metrics file and the log_* / timing entries of history
+        self.metrics_logger.log({'type': 'train', **record})
+        history['log_steps'].append(record['step'])
+        history['log_train_loss'].append(record['train_loss'])
+        for name in ('tokens_per_sec', 'padding_ratio', 'data_ms', 'forward_ms', 'backward_ms', 'optimizer_ms', 'peak_memory_mb'):
+            history[name].append(record[name])
+
+    def _record_evaluation(self, history, step, train_loss, metrics, best_valid_bleu):
+        ## one history record per evaluated step, returns the best BLEU and whether this evaluation improved it
+        history['train_loss'].append(train_loss)
+        history['steps'].append(step)
+        for metric, value in metrics.items():
+            history[metric].append(value)
+        self.metrics_logger.log({'type': 'eval', 'step': step, 'train_loss': train_loss, **metrics})
+        print(f'\n  Validation step-{step}: {metrics}')
+        # Check if the current BLEU score is better than or equal to the best BLEU score
+        # (BLEU of the decoded translations when eval_decoding is on)
+        bleu_name = 'valid_decode_bleu' if 'valid_decode_bleu' in metrics else 'valid_bleu'
+        if metrics[bleu_name] >= best_valid_bleu:
+            print(f"    BLEU score improved from {best_valid_bleu} to {metrics[bleu_name]}")
+            return metrics[bleu_name], True
+        return best_valid_bleu, False
+
+    def _evaluate_snapshot(self, state_dict):
+        ## runs in the evaluation thread
+        self.eval_model.load_state_dict(state_dict)
+        if self.eval_stream is None:
+            return self.evaluate(model=self.eval_model)
+        with torch.cuda.stream(self.eval_stream):
+            metrics = self.evaluate(model=self.eval_model)
+        self.eval_stream.synchronize()
+        return metrics
+
+    def _submit_evaluation(self, step, train_loss):
+        ## the CPU snapshot is the only part done on the training thread
+        state_dict = cpu_snapshot(getattr(self.model, '_orig_mod', self.model).state_dict())
+        self.pending_eval = (step, train_loss, self.eval_executor.submit(self._evaluate_snapshot, state_dict))
+
+    def _collect_evaluation(self, history, best_valid_bleu, wait):
+        if self.pending_eval is None or not (wait or self.pending_eval[2].done()):
+            return best_valid_bleu
+        step, train_loss, future = self.pending_eval
+        self.pending_eval = None
+        best_valid_bleu, improved = self._record_evaluation(history, step, train_loss, future.result(), best_valid_bleu)
+        if improved:
+            ## the weights of the evaluated step (the evaluation model is idle until the next submission),
+            ## without the optimizer state of that step: resume from the save_steps checkpoints
+            save_checkpoint(model=self.eval_model,
+                            optimizer=None,
+                            save_dir=self.args.save_models_dir,
+                            run_name=self.args.run_name,
+                            in_onnx=self.args.onnx,
+                            pad_tokenId=self.collator.pad_value,
+                            training_state={'step': step},
+                            writer=self.checkpoint_writer)
+        return best_valid_bleu
+
+    @staticmethod
+    def _training_state(step, epoch, epoch_step, epoch_rng_state, best_valid_bleu, history, eval_loss=(0.0, 0)):
+        ## eval_loss: (sum, steps) of the train loss since the last evaluation
+        return {'step': step, 'epoch': epoch, 'epoch_step': epoch_step, 'epoch_rng_state': epoch_rng_state,
+                'rng_states': get_rng_states(), 'best_valid_bleu': best_valid_bleu, 'history': dict(history),
+                'eval_loss': eval_loss}
+
     @torch.no_grad()
-    def evaluate(self, dataloader=None, set_name='valid'):
+    def evaluate(self, dataloader=None, set_name='valid', model=None):
+        ## model: self.model by default, the evaluation copy of the model with async_eval
         loader = self.valid_loader if dataloader is None else dataloader
-        self.model = self.model.eval()
-        results_dict = defaultdict(list)
-        for data, labels_forward in loader:
-            data = data.to(self.args.device)
-            labels_forward = labels_forward.to(self.args.device)
+        model = (self.model if model is None else model).eval()
+        device = next(model.parameters()).device
+        ## metric accumulator, e.g. utils.CorpusMetrics
+        metrics = self.compute_metrics_func(self.collator.pad_value)
+        losses = []
+        for data, labels_forward, batch_info in loader:
+            data, labels_forward, batch_kwargs = self._to_device(data, labels_forward, batch_info, device)
 
             if self.args.precision == 'high':
-                with torch.autocast(device_type=self.args.device, dtype=torch.bfloat16):
-                    class_logits, item_total_loss = self.model(source=data,
-                                                               target=labels_forward,
-                                                               pad_tokenId=self.collator.pad_value)
+                with torch.autocast(device_type=device.type, dtype=torch.bfloat16):
+                    class_logits, item_total_loss = model(source=data,
+                                                          target=labels_forward,
+                                                          pad_tokenId=self.collator.pad_value,
+                                                          **batch_kwargs)
             else:
-                class_logits, item_total_loss = self.model(source=data,
-                                                           target=labels_forward,
-                                                           pad_tokenId=self.collator.pad_value)
+                class_logits, item_total_loss = model(source=data,
+                                                      target=labels_forward,
+                                                      pad_tokenId=self.collator.pad_value,
+                                                      **batch_kwargs)
 
             candidates = torch.argmax(class_logits, dim=-1)
-            metrics_dict = self.compute_metrics_func(labels_forward[:,1:], candidates[:,:-1], self.collator.pad_value)
-            metrics_dict['loss'] = item_total_loss.item()
+            metrics.update(labels_forward[:,1:], candidates[:,:-1])
+            losses.append(item_total_loss.detach().float())
 
-            for metric, value in metrics_dict.items():
-                results_dict[set_name+"_"+metric].append(value)
+        ## corpus level BLEU / accuracy over the whole set, loss averaged over the batches
+        to_return = {set_name+"_"+name: round(value, 4) for name, value in metrics.compute().items()}
+        to_return[set_name+"_loss"] = round(torch.stack(losses).mean().item(), 4)
+        if self.args.eval_decoding != 'none':
+            to_return.update(self.evaluate_decoding(loader.dataset, set_name, model))
+        return to_return
 
-        to_return = {}
-        for name, values_list in results_dict.items():
-            if 'accuracy' in name.lower() or 'bleu' in name.lower():
-                to_return[name] = round(sum(values_list)/len(values_list), 4)
-                # to_return[name] = round(sum(values_list)/len(values_list)*100, 2)
-            else:
-                to_return[name] = round(sum(values_list)/len(values_list), 4)
-        return to_return
\ No newline at end of file
+    def _decode_order(self, dataset):
+        ## indices of a seeded random subset of eval_num_samples examples (the splits keep runs of one source corpus
+        ## and of similar lengths), sorted by source length: little padding per batch, the encoder runs once per batch
+        ## (only these examples are tokenized)
+        num_samples = len(dataset) if self.args.eval_num_samples == 0 else min(self.args.eval_num_samples, len(dataset))
+        indices = np.random.default_rng(self.args.seed).choice(len(dataset), num_samples, replace=False)
+        src_lengths = np.array([len(dataset[i][0]) for i in indices.tolist()])
+        return indices[np.argsort(src_lengths, kind='stable')].tolist()
+
+    @torch.no_grad()
+    def evaluate_decoding(self, dataset, set_name='valid', model=None):
+        ## free-running greedy / beam decoding, as at inference, of a seeded random subset of eval_num_samples examples of dataset
+        ## and corpus BLEU of the detokenized translations against the detokenized targets
+        model = self.model if model is None else model
+        model = getattr(model, '_orig_mod', model).eval() # unwrap torch.compile
+        device = next(model.parameters()).device
+        order = self.valid_decode_order if dataset is self.valid_ds else self._decode_order(dataset)
+        num_samples = len(order)
+        batch_size = self.args.batch_size if self.args.eval_decoding == 'greedy' else max(1, self.args.batch_size // self.args.eval_beam_size)
+
+        hypotheses, references = [], []
+        for start in range(0, num_samples, batch_size):
+            source, target, _ = self.collator([dataset[i] for i in order[start:start+batch_size]])
+            source = source.to(device, non_blocking=self.args.pin_memory)
+            with torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=self.args.precision == 'high'):
+                ## both stop as soon as every row has finished
+                if self.args.eval_decoding == 'beam':
+                    tokens = beam_search(model, source, self.tokenizer.sos_tokenId, self.tokenizer.eos_tokenId,
+                                         self.collator.pad_value, beam_size=self.args.eval_beam_size, max_tries=self.args.eval_max_tries)
+                else:
+                    tokens = greedy_decode_batch(model, source, self.tokenizer.sos_tokenId, self.tokenizer.eos_tokenId,
+                                                 self.collator.pad_value, max_tries=self.args.eval_max_tries)
+            ## <s>, </s> and <pad> are dropped by the decoding
+            hypotheses += self.tokenizer.decode_batch(tokens)
+            references += self.tokenizer.decode_batch(target)
+
+        bleu = corpus_bleu([[reference.split()] for reference in references], [hypothesis.split() for hypothesis in hypotheses],
+                           smoothing_function=SmoothingFunction().method2)
+        return {set_name+"_decode_bleu": round(bleu, 4)}
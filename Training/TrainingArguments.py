@@ -66,8 +66,11 @@ class TrainingArguments:
         self.warmup_steps = config.get("warmup_steps")
         assert isinstance(self.warmup_steps, int), "warmup_steps must be an integer."
 
-        # self.save_steps = config.get("save_steps")
-        # assert isinstance(self.save_steps, int), "save_steps must be an integer."
+        self.save_steps = config.get("save_steps", 0)
+        assert isinstance(self.save_steps, int) and self.save_steps >= 0, "save_steps must be a non-negative integer."
+
+        self.save_total_limit = config.get("save_total_limit", 3)
+        assert isinstance(self.save_total_limit, int) and self.save_total_limit >= 0, "save_total_limit must be a non-negative integer."
 
         self.eval_steps = config.get("eval_steps")
         assert isinstance(self.eval_steps, int), "eval_steps must be an integer."
@@ -78,6 +81,41 @@ class TrainingArguments:
         self.lr_decay_ratio = config.get("lr_decay_ratio")
         assert isinstance(self.lr_decay_ratio, float), "lr_decay_ratio must be a float."
 
+        self.loss_chunk_size = config.get("loss_chunk_size", 0)
+        assert isinstance(self.loss_chunk_size, int) and self.loss_chunk_size >= 0, "loss_chunk_size must be a non-negative integer."
+
+        self.max_tokens = config.get("max_tokens", 0)
+        assert isinstance(self.max_tokens, int) and self.max_tokens >= 0, "max_tokens must be a non-negative integer."
+
+        self.bucket_width = config.get("bucket_width", 8)
+        assert isinstance(self.bucket_width, int) and self.bucket_width > 0, "bucket_width must be a positive integer."
+
+        self.eval_decoding = config.get("eval_decoding", "none")
+        assert self.eval_decoding in ["none", "greedy", "beam"], "eval_decoding must be one of ['none', 'greedy', 'beam']."
+
+        self.eval_num_samples = config.get("eval_num_samples", 1000)
+        assert isinstance(self.eval_num_samples, int) and self.eval_num_samples >= 0, "eval_num_samples must be a non-negative integer."
+
+        self.eval_beam_size = config.get("eval_beam_size", 4)
+        assert isinstance(self.eval_beam_size, int) and self.eval_beam_size > 0, "eval_beam_size must be a positive integer."
+
+        self.eval_max_tries = config.get("eval_max_tries", 50)
+        assert isinstance(self.eval_max_tries, int) and self.eval_max_tries > 0, "eval_max_tries must be a positive integer."
+
+        self.async_eval = config.get("async_eval", False)
+        assert isinstance(self.async_eval, bool), "async_eval must be a boolean."
+
+        self.eval_device = config.get("eval_device") or self.device # null = the training device
+        assert isinstance(self.eval_device, str), "eval_device must be a string."
+
+        self.log_steps = config.get("log_steps", 50)
+        assert isinstance(self.log_steps, int) and self.log_steps > 0, "log_steps must be a positive integer."
+
+        ## step-time / throughput records (every log_steps steps) and evaluation records, one JSON per line
+        self.logs_dir = os.path.join(out_dir, 'logs')
+        os.makedirs(self.logs_dir, exist_ok=True)
+        self.metrics_path = os.path.join(self.logs_dir, f"{self.run_name}_metrics.jsonl")
+
 
     def __repr__(self):
         """
@@ -101,8 +139,20 @@ class TrainingArguments:
                 f"  run_name='{self.run_name}',\n" +
                 f"  pin_memory={self.pin_memory},\n" +
                 f"  warmup_steps={self.warmup_steps},\n" +
-                # f"  save_steps={self.save_steps},\n" +
+                f"  save_steps={self.save_steps},\n" +
+                f"  save_total_limit={self.save_total_limit},\n" +
                 f"  eval_steps={self.eval_steps},\n" +
-                f"  torch_compile={self.torch_compile}\n" +
-                f"  lr_decay_ratio={self.lr_decay_ratio}\n" +
+                f"  torch_compile={self.torch_compile},\n" +
+                f"  lr_decay_ratio={self.lr_decay_ratio},\n" +
+                f"  loss_chunk_size={self.loss_chunk_size},\n" +
+                f"  max_tokens={self.max_tokens},\n" +
+                f"  bucket_width={self.bucket_width},\n" +
+                f"  eval_decoding='{self.eval_decoding}',\n" +
+                f"  eval_num_samples={self.eval_num_samples},\n" +
+                f"  eval_beam_size={self.eval_beam_size},\n" +
+                f"  eval_max_tries={self.eval_max_tries},\n" +
+                f"  async_eval={self.async_eval},\n" +
+                f"  eval_device='{self.eval_device}',\n" +
+                f"  log_steps={self.log_steps},\n" +
+                f"  metrics_path='{self.metrics_path}'\n" +
                 ")")
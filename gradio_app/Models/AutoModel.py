@@ -1,10 +1,27 @@
+import torch
+from torch import nn
 from Models.seq2seq_model import Seq2seq_no_attention
 from Models.seq2seqAttention_model import Seq2seq_with_attention
 from Models.Transformer_model import NMT_Transformer
 from Models.ModelArgs import ModelArgs
 
+## Linear layers whose weights are sliced directly (not called as modules) must stay in float
+FLOAT_ONLY_MODULES = ('fc_energy',)
 
-def get_model(params:ModelArgs, vocab_size):
+
+def quantize_model(model:nn.Module):
+    """
+    Dynamic int8 quantization (weights int8, activations quantized on the fly) of every nn.Linear and nn.GRU.
+
+    The classifier gets its own int8 copy of the weight it shares with the embeddings, the embeddings stay in float.
+    """
+    qconfig_spec = {name: torch.ao.quantization.default_dynamic_qconfig
+                    for name, module in model.named_modules()
+                    if type(module) in (nn.Linear, nn.GRU) and not name.endswith(FLOAT_ONLY_MODULES)}
+    return torch.ao.quantization.quantize_dynamic(model, qconfig_spec, dtype=torch.qint8)
+
+
+def get_model(params:ModelArgs, vocab_size, quantized=False):
 
     if params.model_type.lower() == 's2s': model = Seq2seq_no_attention(vocab_size=vocab_size,
                                                         dim_embed=params.dim_embed,
@@ -20,12 +37,17 @@ def get_model(params:ModelArgs, vocab_size):
                                                                                  num_layers=params.num_layers,
                                                                                  dropout_probability=params.dropout)
 
+    ## The quantized transformer always uses the scaled_dot_product_attention blocks (same state dict layout),
+    ## nn.TransformerEncoder's fast path reads Linear weights as tensors and does not support quantized Linear.
     else: model = NMT_Transformer(vocab_size=vocab_size,
                                 dim_embed=params.dim_embed,
                                 dim_model=params.dim_model,
                                 dim_feedforward=params.dim_feedforward,
                                 num_layers=params.num_layers,
                                 dropout_probability=params.dropout,
-                                maxlen=params.maxlen)
+                                maxlen=params.maxlen,
+                                flash_attention=params.flash_attention or quantized,
+                                num_heads=params.num_heads)
+
+    if quantized: model = quantize_model(model)
     return model
-    
\ No newline at end of file
@@ -0,0 +1,41 @@
+import torch
+from torch import nn
+from torch.utils.checkpoint import checkpoint
+
+
+def _chunk_loss(classifier, hidden, targets):
+    logits = classifier(hidden)
+    return nn.functional.cross_entropy(logits, targets, reduction='sum')
+
+
+def chunked_cross_entropy(hidden:torch.Tensor, classifier:nn.Module, targets:torch.Tensor, ignore_index:int, chunk_size:int):
+    """
+    Cross-entropy of classifier(hidden) against targets without materializing the (B, T, vocab_size) logits.
+
+    Pad positions are dropped before the classifier, the remaining tokens are projected and scored
+    chunk_size at a time. Under autograd every chunk is checkpointed, so its logits are recomputed
+    in backward instead of being kept alive until then.
+
+    Args:
+        hidden (Tensor): Decoder outputs of shape (B, T, dim_model), aligned with targets.
+        classifier (nn.Module): Projection from dim_model to vocab_size.
+        targets (Tensor): Target token ids of shape (B, T).
+        ignore_index (int): Target id to skip (the <pad> token).
+        chunk_size (int): Number of target tokens projected at once.
+
+    Returns:
+        Tensor: Mean loss over the non-ignored tokens, equal to
+        cross_entropy(classifier(hidden).reshape(-1, V), targets.reshape(-1), ignore_index=ignore_index).
+    """
+    keep = targets != ignore_index
+    hidden = hidden[keep] # (N, dim_model)
+    targets = targets[keep] # (N,)
+    total_loss = hidden.new_zeros((), dtype=torch.float32)
+    for start in range(0, targets.size(0), chunk_size):
+        hidden_chunk = hidden[start:start+chunk_size]
+        targets_chunk = targets[start:start+chunk_size]
+        if torch.is_grad_enabled():
+            total_loss = total_loss + checkpoint(_chunk_loss, classifier, hidden_chunk, targets_chunk, use_reentrant=False)
+        else:
+            total_loss = total_loss + _chunk_loss(classifier, hidden_chunk, targets_chunk)
+    return total_loss / targets.size(0)
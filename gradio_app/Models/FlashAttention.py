@@ -0,0 +1,137 @@
+import torch
+from torch import nn
+
+## Transformer blocks built on torch.nn.functional.scaled_dot_product_attention.
+## Parameter names mirror nn.TransformerEncoder/DecoderLayer(norm_first=True) and nn.MultiheadAttention,
+## so checkpoints load in either direction with the same state dict layout.
+
+
+class SDPA_MultiheadAttention(nn.Module):
+    def __init__(self, embed_dim, num_heads, dropout=0.0):
+        super().__init__()
+        assert embed_dim % num_heads == 0, "embed_dim must be divisible by num_heads."
+        self.embed_dim = embed_dim
+        self.num_heads = num_heads
+        self.dropout = dropout
+
+        self.in_proj_weight = nn.Parameter(torch.empty(3 * embed_dim, embed_dim))
+        self.in_proj_bias = nn.Parameter(torch.empty(3 * embed_dim))
+        self.out_proj = nn.Linear(embed_dim, embed_dim)
+        ## same initialization as nn.MultiheadAttention
+        nn.init.xavier_uniform_(self.in_proj_weight)
+        nn.init.zeros_(self.in_proj_bias)
+        nn.init.zeros_(self.out_proj.bias)
+
+    def _split_heads(self, x):
+        B, T, D = x.shape
+        return x.view(B, T, self.num_heads, D // self.num_heads).transpose(1, 2) # (B, nh, T, hd)
+
+    def forward(self, query, key_value, attn_mask=None, is_causal=False):
+        ## attn_mask: bool, True = attend (sdpa convention), broadcastable to (B, nh, Tq, Tk)
+        if query is key_value:
+            q, k, v = nn.functional.linear(query, self.in_proj_weight, self.in_proj_bias).chunk(3, dim=-1)
+        else:
+            E = self.embed_dim
+            q = nn.functional.linear(query, self.in_proj_weight[:E], self.in_proj_bias[:E])
+            k, v = nn.functional.linear(key_value, self.in_proj_weight[E:], self.in_proj_bias[E:]).chunk(2, dim=-1)
+
+        ## sdpa dispatches to the fused kernels (flash / memory-efficient on GPU, flash on CPU)
+        ## and falls back to the math implementation when a kernel does not support the inputs
+        out = nn.functional.scaled_dot_product_attention(self._split_heads(q), self._split_heads(k), self._split_heads(v),
+                                                         attn_mask=attn_mask,
+                                                         dropout_p=self.dropout if self.training else 0.0,
+                                                         is_causal=is_causal)
+        B, nh, T, hd = out.shape
+        return self.out_proj(out.transpose(1, 2).reshape(B, T, nh * hd))
+
+
+class SDPA_TransformerEncoderLayer(nn.Module):
+    def __init__(self, d_model, nhead, dim_feedforward, dropout):
+        super().__init__()
+        self.self_attn = SDPA_MultiheadAttention(d_model, nhead, dropout)
+        self.linear1 = nn.Linear(d_model, dim_feedforward)
+        self.dropout = nn.Dropout(dropout)
+        self.linear2 = nn.Linear(dim_feedforward, d_model)
+        self.norm1 = nn.LayerNorm(d_model)
+        self.norm2 = nn.LayerNorm(d_model)
+        self.dropout1 = nn.Dropout(dropout)
+        self.dropout2 = nn.Dropout(dropout)
+        self.activation = nn.functional.relu
+
+    def forward(self, x, attn_mask=None):
+        h = self.norm1(x)
+        x = x + self.dropout1(self.self_attn(h, h, attn_mask=attn_mask))
+        x = x + self.dropout2(self.linear2(self.dropout(self.activation(self.linear1(self.norm2(x))))))
+        return x
+
+
+class SDPA_TransformerDecoderLayer(nn.Module):
+    def __init__(self, d_model, nhead, dim_feedforward, dropout):
+        super().__init__()
+        self.self_attn = SDPA_MultiheadAttention(d_model, nhead, dropout)
+        self.multihead_attn = SDPA_MultiheadAttention(d_model, nhead, dropout)
+        self.linear1 = nn.Linear(d_model, dim_feedforward)
+        self.dropout = nn.Dropout(dropout)
+        self.linear2 = nn.Linear(dim_feedforward, d_model)
+        self.norm1 = nn.LayerNorm(d_model)
+        self.norm2 = nn.LayerNorm(d_model)
+        self.norm3 = nn.LayerNorm(d_model)
+        self.dropout1 = nn.Dropout(dropout)
+        self.dropout2 = nn.Dropout(dropout)
+        self.dropout3 = nn.Dropout(dropout)
+        self.activation = nn.functional.relu
+
+    def forward(self, x, memory, memory_attn_mask=None):
+        h = self.norm1(x)
+        x = x + self.dropout1(self.self_attn(h, h, is_causal=True))
+        x = x + self.dropout2(self.multihead_attn(self.norm2(x), memory, attn_mask=memory_attn_mask))
+        x = x + self.dropout3(self.linear2(self.dropout(self.activation(self.linear1(self.norm3(x))))))
+        return x
+
+
+class SDPA_TransformerEncoder(nn.Module):
+    """
+    Drop-in replacement for nn.TransformerEncoder (norm_first=True layers, no final norm).
+    """
+    def __init__(self, d_model, nhead, dim_feedforward, dropout, num_layers):
+        super().__init__()
+        self.layers = nn.ModuleList([SDPA_TransformerEncoderLayer(d_model, nhead, dim_feedforward, dropout)
+                                     for _ in range(num_layers)])
+
+    def forward(self, src, mask=None, src_key_padding_mask=None, is_causal=False):
+        assert mask is None and not is_causal, "Only key padding masks are supported by the encoder."
+        attn_mask = None
+        if src_key_padding_mask is not None:
+            B, Ts = src_key_padding_mask.shape
+            attn_mask = (~src_key_padding_mask).view(B, 1, 1, Ts)
+        x = src
+        for layer in self.layers:
+            x = layer(x, attn_mask)
+        return x
+
+
+class SDPA_TransformerDecoder(nn.Module):
+    """
+    Drop-in replacement for nn.TransformerDecoder (norm_first=True layers, no final norm).
+
+    Self-attention always uses the fused causal mask (tgt_mask is expected to be the square
+    subsequent mask and is not materialized). With right-padded targets a causal
+    query never sees a later <pad> key, so tgt_key_padding_mask only changes the outputs at
+    <pad> positions (which are ignored by the loss) and is not applied.
+    """
+    def __init__(self, d_model, nhead, dim_feedforward, dropout, num_layers):
+        super().__init__()
+        self.layers = nn.ModuleList([SDPA_TransformerDecoderLayer(d_model, nhead, dim_feedforward, dropout)
+                                     for _ in range(num_layers)])
+
+    def forward(self, tgt, memory, tgt_mask=None, memory_mask=None,
+                tgt_key_padding_mask=None, memory_key_padding_mask=None):
+        assert memory_mask is None, "Only key padding masks are supported for the memory."
+        memory_attn_mask = None
+        if memory_key_padding_mask is not None:
+            B, Ts = memory_key_padding_mask.shape
+            memory_attn_mask = (~memory_key_padding_mask).view(B, 1, 1, Ts)
+        x = tgt
+        for layer in self.layers:
+            x = layer(x, memory, memory_attn_mask)
+        return x
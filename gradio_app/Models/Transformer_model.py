@@ -1,11 +1,14 @@
 import torch
 from torch import nn
+from Models.ChunkedLoss import chunked_cross_entropy
+from Models.FlashAttention import SDPA_TransformerEncoder, SDPA_TransformerDecoder
 
 
 class NMT_Transformer(nn.Module):
     def __init__(self, vocab_size:int, dim_embed:int,
                  dim_model:int, dim_feedforward:int, num_layers:int,
-                 dropout_probability:float, maxlen:int):
+                 dropout_probability:float, maxlen:int,
+                 flash_attention:bool=False, num_heads:int=8):
         super().__init__()
 
         self.embed_shared_src_trg_cls = nn.Embedding(num_embeddings=vocab_size, embedding_dim=dim_embed)
@@ -16,17 +19,28 @@ class NMT_Transformer(nn.Module):
 
         self.dropout = nn.Dropout(dropout_probability)
 
-        encoder_layer = nn.TransformerEncoderLayer(d_model=dim_model, nhead=8,
-                                                   dim_feedforward=dim_feedforward,
-                                                   dropout=dropout_probability,
-                                                   batch_first=True, norm_first=True)
-        self.transformer_encoder = nn.TransformerEncoder(encoder_layer, num_layers=num_layers, enable_nested_tensor=False)
-
-        decoder_layer = nn.TransformerDecoderLayer(d_model=dim_model, nhead=8,
-                                                   dim_feedforward=dim_feedforward,
-                                                   dropout=dropout_probability,
-                                                   batch_first=True, norm_first=True)
-        self.transformer_decoder = nn.TransformerDecoder(decoder_layer, num_layers=num_layers)
+        if flash_attention:
+            ## scaled_dot_product_attention based blocks, same state dict layout as the nn.Transformer* ones
+            self.transformer_encoder = SDPA_TransformerEncoder(d_model=dim_model, nhead=num_heads,
+                                                               dim_feedforward=dim_feedforward,
+                                                               dropout=dropout_probability,
+                                                               num_layers=num_layers)
+            self.transformer_decoder = SDPA_TransformerDecoder(d_model=dim_model, nhead=num_heads,
+                                                               dim_feedforward=dim_feedforward,
+                                                               dropout=dropout_probability,
+                                                               num_layers=num_layers)
+        else:
+            encoder_layer = nn.TransformerEncoderLayer(d_model=dim_model, nhead=num_heads,
+                                                       dim_feedforward=dim_feedforward,
+                                                       dropout=dropout_probability,
+                                                       batch_first=True, norm_first=True)
+            self.transformer_encoder = nn.TransformerEncoder(encoder_layer, num_layers=num_layers, enable_nested_tensor=False)
+
+            decoder_layer = nn.TransformerDecoderLayer(d_model=dim_model, nhead=num_heads,
+                                                       dim_feedforward=dim_feedforward,
+                                                       dropout=dropout_probability,
+                                                       batch_first=True, norm_first=True)
+            self.transformer_decoder = nn.TransformerDecoder(decoder_layer, num_layers=num_layers)
         
         self.classifier = nn.Linear(dim_model, vocab_size)
         ## weight sharing between classifier and embed_shared_src_trg_cls
@@ -46,9 +60,12 @@ class NMT_Transformer(nn.Module):
             torch.nn.init.ones_(module.weight)
             torch.nn.init.zeros_(module.bias)
     
-    def forward(self, source, target, pad_tokenId):
+    def forward(self, source, target, pad_tokenId, loss_chunk_size=0,
+                source_lengths=None, src_pad_mask=None, trg_pad_mask=None):
         # target = <sos> + text + <eos>
         # source = text
+        # loss_chunk_size > 0: only the loss is computed (chunked), logits are returned as None
+        # source_lengths / pad masks: optional, precomputed by MyCollate (source_lengths is not needed here)
         B, Ts = source.shape
         B, Tt = target.shape
         device = source.device
@@ -56,21 +73,24 @@ class NMT_Transformer(nn.Module):
         src_poses = self.positonal_shared_src_trg(torch.arange(0, Ts).to(device).unsqueeze(0).repeat(B, 1))
         src_embedings = self.dropout(self.embed_shared_src_trg_cls(source) + src_poses)
 
-        src_pad_mask = source == pad_tokenId
+        if src_pad_mask is None: src_pad_mask = source == pad_tokenId
         memory = self.transformer_encoder(src=src_embedings, mask=None, src_key_padding_mask=src_pad_mask, is_causal=False)
         ## Decoder Path
         trg_poses = self.positonal_shared_src_trg(torch.arange(0, Tt).to(device).unsqueeze(0).repeat(B, 1))
         trg_embedings = self.dropout(self.embed_shared_src_trg_cls(target) + trg_poses)
         
-        trg_pad_mask = target == pad_tokenId
+        if trg_pad_mask is None: trg_pad_mask = target == pad_tokenId
         tgt_mask = torch.nn.Transformer.generate_square_subsequent_mask(Tt, dtype=bool).to(device)
         decoder_out = self.transformer_decoder.forward(tgt=trg_embedings,
                                                 memory=memory,
                                                 tgt_mask=tgt_mask,
                                                 memory_mask=None,
                                                 tgt_key_padding_mask=trg_pad_mask,
-                                                memory_key_padding_mask=None)
+                                                memory_key_padding_mask=src_pad_mask)
         ## Classifier Path
+        if loss_chunk_size and Tt > 1:
+            loss = chunked_cross_entropy(decoder_out[:,:-1], self.classifier, target[:,1:], pad_tokenId, loss_chunk_size)
+            return None, loss
         logits = self.classifier(decoder_out)
         loss = None
         if Tt > 1:
@@ -82,41 +102,102 @@ class NMT_Transformer(nn.Module):
         return logits, loss
     
 
-    @torch.no_grad
-    def greedy_decode_fast(self, source_tensor:torch.Tensor, sos_tokenId: int, eos_tokenId:int, pad_tokenId, max_tries=50):
-        self.eval()
-        source_tensor = source_tensor.unsqueeze(0)
-        B, Ts = source_tensor.shape
-        device = source_tensor.device
-        target_tensor = torch.tensor([sos_tokenId]).unsqueeze(0).to(device)
+    def _init_decoder_cache(self, memory, memory_pad_mask):
+        ## Cross-attention keys/values only depend on the encoder memory, so they are
+        ## projected once per sentence. Self-attention keys/values grow by one token per step.
+        B, Ts, D = memory.shape
+        memory_attn_mask = (~memory_pad_mask).view(B, 1, 1, Ts) # True = attend (sdpa convention)
+        layers_cache = []
+        for layer in self.transformer_decoder.layers:
+            cross_attn = layer.multihead_attn
+            _, w_k, w_v = cross_attn.in_proj_weight.chunk(3, dim=0)
+            _, b_k, b_v = cross_attn.in_proj_bias.chunk(3, dim=0)
+            layers_cache.append({'self_k': None,
+                                 'self_v': None,
+                                 'cross_k': self._split_heads(nn.functional.linear(memory, w_k, b_k), cross_attn.num_heads),
+                                 'cross_v': self._split_heads(nn.functional.linear(memory, w_v, b_v), cross_attn.num_heads)})
+        return {'layers': layers_cache, 'memory_attn_mask': memory_attn_mask, 'self_attn_mask': None}
 
-        ## Encoder Path
+    @staticmethod
+    def _split_heads(x, num_heads):
+        B, T, D = x.shape
+        return x.view(B, T, num_heads, D // num_heads).transpose(1, 2) # (B, nh, T, hd)
+
+    @staticmethod
+    def _merge_heads(x):
+        B, nh, T, hd = x.shape
+        return x.transpose(1, 2).reshape(B, T, nh * hd)
+
+    def _decode_cached(self, step_tokens, step, cache, pad_tokenId):
+        ## Runs the decoder for the newest token only, attending over the cached prefix.
+        ## Mirrors nn.TransformerDecoderLayer(norm_first=True) in eval mode.
+        ## step_tokens shape: (B, 1), returns logits of shape (B, vocab_size)
+        B = step_tokens.size(0)
+        ## step is an int, or an int64 tensor of shape (1,) in the exported ONNX decoder-step graph
+        step_pos = torch.zeros_like(step_tokens) + step
+        x = self.embed_shared_src_trg_cls(step_tokens) + self.positonal_shared_src_trg(step_pos)
+
+        ## keys that are <pad> tokens are ignored exactly like tgt_key_padding_mask does
+        step_attn_mask = (step_tokens != pad_tokenId).view(B, 1, 1, 1)
+        if cache['self_attn_mask'] is None: self_attn_mask = step_attn_mask
+        else: self_attn_mask = torch.cat([cache['self_attn_mask'], step_attn_mask], dim=-1)
+        cache['self_attn_mask'] = self_attn_mask
+
+        for layer, layer_cache in zip(self.transformer_decoder.layers, cache['layers']):
+            ## Self-attention block
+            self_attn = layer.self_attn
+            q, k, v = nn.functional.linear(layer.norm1(x), self_attn.in_proj_weight, self_attn.in_proj_bias).chunk(3, dim=-1)
+            k = self._split_heads(k, self_attn.num_heads)
+            v = self._split_heads(v, self_attn.num_heads)
+            if layer_cache['self_k'] is not None:
+                k = torch.cat([layer_cache['self_k'], k], dim=2)
+                v = torch.cat([layer_cache['self_v'], v], dim=2)
+            layer_cache['self_k'], layer_cache['self_v'] = k, v
+            attn = nn.functional.scaled_dot_product_attention(self._split_heads(q, self_attn.num_heads), k, v,
+                                                              attn_mask=self_attn_mask)
+            x = x + self_attn.out_proj(self._merge_heads(attn))
+
+            ## Cross-attention block
+            cross_attn = layer.multihead_attn
+            w_q = cross_attn.in_proj_weight[:cross_attn.embed_dim]
+            b_q = cross_attn.in_proj_bias[:cross_attn.embed_dim]
+            q = nn.functional.linear(layer.norm2(x), w_q, b_q)
+            attn = nn.functional.scaled_dot_product_attention(self._split_heads(q, cross_attn.num_heads),
+                                                              layer_cache['cross_k'], layer_cache['cross_v'],
+                                                              attn_mask=cache['memory_attn_mask'])
+            x = x + cross_attn.out_proj(self._merge_heads(attn))
+
+            ## Feed-forward block
+            x = x + layer.linear2(layer.activation(layer.linear1(layer.norm3(x))))
+
+        return self.classifier(x).squeeze(1)
+
+    def encode(self, source, pad_tokenId):
+        ## Runs the encoder once and returns the incremental decoding state
+        B, Ts = source.shape
+        device = source.device
         src_poses = self.positonal_shared_src_trg(torch.arange(0, Ts).to(device).unsqueeze(0).repeat(B, 1))
-        src_embedings = self.embed_shared_src_trg_cls(source_tensor) + src_poses
-        src_pad_mask = source_tensor == pad_tokenId
-        context = self.transformer_encoder(src=src_embedings, mask=None, src_key_padding_mask=src_pad_mask, is_causal=False)
-
-        for i in range(max_tries):
-            ## Decoder Path
-            trg_poses = self.positonal_shared_src_trg(torch.arange(0, i+1).to(device).unsqueeze(0).repeat(B, 1))
-            trg_embedings = self.embed_shared_src_trg_cls(target_tensor) + trg_poses
-            
-            trg_pad_mask = target_tensor == pad_tokenId
-            tgt_mask = torch.nn.Transformer.generate_square_subsequent_mask(i+1, dtype=bool).to(device)
-            decoder_out = self.transformer_decoder.forward(tgt=trg_embedings,
-                                                    memory=context,
-                                                    tgt_mask=tgt_mask,
-                                                    memory_mask=None,
-                                                    tgt_key_padding_mask=trg_pad_mask,
-                                                    memory_key_padding_mask=None)
-            ## Classifier Path
-            logits = self.classifier(decoder_out)
-            # Greedy decoding
-            top1 = logits[:,-1,:].argmax(dim=-1, keepdim=True)
-            # Append predicted token
-            target_tensor = torch.cat([target_tensor, top1], dim=1)
-            
-            # Stop if predict <EOS>
-            if top1.item() == eos_tokenId:
-                break
-        return target_tensor.squeeze(0).tolist()
\ No newline at end of file
+        src_embedings = self.embed_shared_src_trg_cls(source) + src_poses
+        src_pad_mask = source == pad_tokenId
+        memory = self.transformer_encoder(src=src_embedings, mask=None, src_key_padding_mask=src_pad_mask, is_causal=False)
+        state = self._init_decoder_cache(memory, src_pad_mask)
+        state['step'] = 0
+        state['pad_tokenId'] = pad_tokenId
+        return state
+
+    def decode_step(self, state, last_tokens):
+        ## last_tokens shape: (B, 1), returns logits of shape (B, vocab_size) and the updated state
+        logits = self._decode_cached(last_tokens, state['step'], state, state['pad_tokenId'])
+        state['step'] = state['step'] + 1
+        return logits, state
+
+    def reorder_state(self, state, index):
+        ## Selects/repeats batch rows of the state (used to expand and reorder beams)
+        layers_cache = [{name: None if value is None else value.index_select(0, index)
+                         for name, value in layer_cache.items()} for layer_cache in state['layers']]
+        self_attn_mask = state['self_attn_mask']
+        return {'layers': layers_cache,
+                'memory_attn_mask': state['memory_attn_mask'].index_select(0, index),
+                'self_attn_mask': None if self_attn_mask is None else self_attn_mask.index_select(0, index),
+                'step': state['step'],
+                'pad_tokenId': state['pad_tokenId']}
@@ -1,11 +1,19 @@
 import torch
+import os
 from Models.ModelArgs import ModelArgs
 from Models.AutoModel import get_model
-from gradio_utils import Callable_tokenizer, greedy_decode
+from gradio_utils import Callable_tokenizer, greedy_decode, beam_search
 import gradio as gr
 
-def en_translate_ar_beam(text, model, tokenizer, max_tries=50):
-    return "future work"
+def en_translate_ar_beam(text, model, tokenizer, max_tries=50, beam_size=4):
+    source_tensor = torch.tensor(tokenizer(text)).unsqueeze(0).to(device)
+    target_tokens = beam_search(model, source_tensor,
+                                tokenizer.get_tokenId('<s>'),
+                                tokenizer.get_tokenId('</s>'),
+                                tokenizer.get_tokenId('<pad>'),
+                                beam_size=beam_size, max_tries=max_tries)[0]
+
+    return tokenizer.decode(target_tokens)
 
 
 def en_translate_ar_greedy(text, model, tokenizer, max_tries=50):
@@ -21,26 +29,27 @@ def en_translate_ar_greedy(text, model, tokenizer, max_tries=50):
 device = 'cuda' if torch.cuda.is_available() else 'cpu'
 tokenizer = Callable_tokenizer('./assets/tokenizers/en-ar_tokenizer.model')
 
-model_state_dict = torch.load("./assets/models/en-ar_s2sAttention.pth", map_location=device, weights_only=True)['model_state_dict']
-model_args = ModelArgs('s2sattention', "./Configurations/s2sattention_model_config.json")
-s2sattention = get_model(model_args, len(tokenizer))
-s2sattention.load_state_dict(model_state_dict)
-s2sattention.to(device)
-s2sattention.eval()
-
-model_state_dict = torch.load("./assets/models/en-ar_s2s.pth", map_location=device, weights_only=True)['model_state_dict']
-model_args = ModelArgs('s2s', "./Configurations/s2s_model_config.json")
-s2s = get_model(model_args, len(tokenizer))
-s2s.load_state_dict(model_state_dict)
-s2s.to(device)
-s2s.eval()
-
-model_state_dict = torch.load("./assets/models/en-ar_transformer.pth", map_location=device, weights_only=True)['model_state_dict']
-model_args = ModelArgs('transformer', "./Configurations/transformer_model_config.json")
-transformer = get_model(model_args, len(tokenizer))
-transformer.load_state_dict(model_state_dict)
-transformer.to(device)
-transformer.eval()
+def load_model(model_type, run_name, config_path):
+    ## On CPU prefer the dynamically quantized int8 checkpoint (made by quantize_workflow.py) when it is available
+    int8_path = f"./assets/models/{run_name}_int8.pth"
+    quantized = device == 'cpu' and os.path.exists(int8_path)
+    model_args = ModelArgs(model_type, config_path)
+    model = get_model(model_args, len(tokenizer), quantized=quantized)
+    if quantized:
+        ## quantized GRU weights are stored as packed ScriptObjects
+        with torch.serialization.safe_globals([torch.ScriptObject]):
+            model_state_dict = torch.load(int8_path, map_location=device, weights_only=True)['model_state_dict']
+    else:
+        model_state_dict = torch.load(f"./assets/models/{run_name}.pth", map_location=device, weights_only=True)['model_state_dict']
+    model.load_state_dict(model_state_dict)
+    model.to(device)
+    model.eval()
+    return model
+
+
+s2sattention = load_model('s2sattention', 'en-ar_s2sAttention', "./Configurations/s2sattention_model_config.json")
+s2s = load_model('s2s', 'en-ar_s2s', "./Configurations/s2s_model_config.json")
+transformer = load_model('transformer', 'en-ar_transformer', "./Configurations/transformer_model_config.json")
 
 
 def launch_translation_greedy(raw_input, maxtries=50):
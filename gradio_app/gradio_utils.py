@@ -1,12 +1,20 @@
 import sentencepiece as spm
+import itertools
 import torch
 
 ## Tokenizer
 class Callable_tokenizer():
-    def __init__(self, tokenizer_path):
+    def __init__(self, tokenizer_path, num_threads=-1):
         self.path = tokenizer_path
         self.tokenizer = spm.SentencePieceProcessor()
         self.tokenizer.load(tokenizer_path)
+        ## threads of the batch methods, -1 = all cores
+        self.num_threads = num_threads
+        ## special token ids, looked up once
+        self.sos_tokenId = self.get_tokenId('<s>')
+        self.eos_tokenId = self.get_tokenId('</s>')
+        self.pad_tokenId = self.get_tokenId('<pad>')
+
     def __call__(self, text):
         return self.tokenizer.Encode(text)
 
@@ -23,7 +31,50 @@ class Callable_tokenizer():
         return len(self.tokenizer)
 
     def user_tokenization(self, text):
-        return self(text) + [self.get_tokenId('</s>')]
+        return self(text) + [self.eos_tokenId]
+
+    def encode_batch(self, texts:list, add_sos=False, add_eos=False):
+        """
+        Encode a list of sentences with SentencePiece's multi-threaded batch encoding.
+
+        Returns:
+            List[List[int]]: Ragged token ids, one list per sentence.
+        """
+        return self.tokenizer.Encode(texts, add_bos=add_sos, add_eos=add_eos, num_threads=self.num_threads)
+
+    def encode_batch_padded(self, texts:list, add_sos=False, add_eos=False, pad_tokenId=None):
+        """
+        Encode a list of sentences into a right-padded batch.
+
+        Returns:
+            Tuple[torch.Tensor, torch.Tensor]: Token ids (B, T) and lengths (B,), both int64.
+        """
+        tokens_list = self.encode_batch(texts, add_sos=add_sos, add_eos=add_eos)
+        pad_tokenId = self.pad_tokenId if pad_tokenId is None else pad_tokenId
+        lengths = torch.tensor([len(tokens) for tokens in tokens_list], dtype=torch.long)
+        padded = torch.full((len(tokens_list), int(lengths.max()) if len(tokens_list) else 0), pad_tokenId, dtype=torch.long)
+        ## scatter all ids at once through the (B, T) mask of the real positions
+        mask = torch.arange(padded.size(1)) < lengths.unsqueeze(1)
+        padded[mask] = torch.tensor(list(itertools.chain.from_iterable(tokens_list)), dtype=torch.long)
+        return padded, lengths
+
+    def decode_batch(self, tokens_batch, lengths=None):
+        """
+        Decode a batch of token ids with SentencePiece's multi-threaded batch decoding.
+
+        Args:
+            tokens_batch (List[List[int]] | torch.Tensor): Ragged lists or a (B, T) tensor.
+            lengths (torch.Tensor): Optional lengths of the rows of a padded tensor.
+                Without lengths, <pad>, <s> and </s> are dropped by SentencePiece anyway.
+
+        Returns:
+            List[str]: One sentence per row.
+        """
+        if torch.is_tensor(tokens_batch):
+            tokens_batch = tokens_batch.tolist()
+        if lengths is not None:
+            tokens_batch = [tokens[:length] for tokens, length in zip(tokens_batch, lengths.tolist())]
+        return self.tokenizer.Decode(tokens_batch, num_threads=self.num_threads)
 
 
 @torch.no_grad
@@ -32,10 +83,12 @@ def greedy_decode(model:torch.nn.Module, source_tensor:torch.Tensor, sos_tokenId
     device = source_tensor.device
     target_tensor = torch.tensor([sos_tokenId]).unsqueeze(0).to(device)
 
+    # Encode once, then feed only the newest token to the decoder
+    state = model.encode(source_tensor, pad_tokenId)
     for i in range(max_tries):
-        logits, _ = model(source_tensor, target_tensor, pad_tokenId)
+        logits, state = model.decode_step(state, target_tensor[:, -1:])
         # Greedy decoding
-        top1 = logits[:,-1,:].argmax(dim=-1, keepdim=True)
+        top1 = logits.argmax(dim=-1, keepdim=True)
         # Append predicted token
         target_tensor = torch.cat([target_tensor, top1], dim=1)
         # Stop if predict <EOS>
@@ -51,4 +104,64 @@ def en_translate_ar(text, model, tokenizer):
                                   tokenizer.get_tokenId('</s>'),
                                   tokenizer.get_tokenId('<pad>'), 30)
     
-    return tokenizer.decode(target_tokens)
\ No newline at end of file
+    return tokenizer.decode(target_tokens)
+
+@torch.no_grad
+def beam_search(model:torch.nn.Module, source_tensor:torch.Tensor, sos_tokenId: int, eos_tokenId:int, pad_tokenId,
+                beam_size=4, max_tries=50, length_penalty=1.0, early_stopping=True):
+    ## source_tensor: padded batch of shape (B, Ts)
+    ## Beams are kept as extra batch rows (B*beam_size) and the encoder runs once per sentence.
+    ## Hypotheses are ranked by score / length**length_penalty. Finished beams are frozen (they only
+    ## extend with <pad> at zero cost). A sentence stops when its best beam has finished (early_stopping)
+    ## or when all of its beams have finished.
+    ## returns the best token list per sentence (<s> ... </s>)
+    model.eval()
+    B = source_tensor.size(0)
+    K = beam_size
+    device = source_tensor.device
+
+    state = model.encode(source_tensor, pad_tokenId)
+    state = model.reorder_state(state, torch.arange(B, device=device).repeat_interleave(K))
+
+    step_tokens = torch.full((B*K, 1), sos_tokenId, dtype=torch.long, device=device)
+    targets_hat = step_tokens
+    ## only the first beam of each sentence is alive at the start, the others are copies of it
+    scores = torch.zeros(B, K, device=device)
+    scores[:, 1:] = float('-inf')
+    scores = scores.view(-1)
+    lengths = torch.zeros(B*K, dtype=torch.long, device=device)
+    finished = torch.zeros(B*K, dtype=torch.bool, device=device)
+    beam_offsets = (torch.arange(B, device=device) * K).unsqueeze(1) # (B, 1)
+
+    for step in range(max_tries):
+        logits, state = model.decode_step(state, step_tokens)
+        log_probs = torch.log_softmax(logits.float(), dim=-1) # (B*K, V)
+        V = log_probs.size(-1)
+        ## finished beams can only be extended with <pad>, keeping their score unchanged
+        pad_log_probs = torch.where(finished, 0.0, log_probs[:, pad_tokenId])
+        log_probs = log_probs.masked_fill(finished.unsqueeze(1), float('-inf'))
+        log_probs[:, pad_tokenId] = pad_log_probs
+
+        candidate_scores = scores.unsqueeze(1) + log_probs # (B*K, V)
+        candidate_lengths = lengths + (~finished).long()
+        normalized = candidate_scores / candidate_lengths.float().pow(length_penalty).unsqueeze(1)
+        _, top_idx = normalized.view(B, K*V).topk(K, dim=-1) # (B, K)
+
+        rows = (beam_offsets + top_idx // V).view(-1)
+        step_tokens = (top_idx % V).view(-1, 1)
+        scores = candidate_scores.view(B, K*V).gather(1, top_idx).view(-1)
+        lengths = candidate_lengths.index_select(0, rows)
+        finished = finished.index_select(0, rows) | (step_tokens.squeeze(1) == eos_tokenId)
+        targets_hat = torch.cat([targets_hat.index_select(0, rows), step_tokens], dim=1)
+        state = model.reorder_state(state, rows)
+
+        ## top_idx is sorted, so beam 0 of each sentence is its current best hypothesis
+        if early_stopping: done = finished.view(B, K)[:, 0]
+        else: done = finished.view(B, K).all(dim=-1)
+        if done.all():
+            break
+        ## freeze sentences that are done so their best beam can not be overtaken
+        finished = finished | done.repeat_interleave(K)
+
+    best = targets_hat.view(B, K, -1)[:, 0].tolist()
+    return [row[:length+1] for row, length in zip(best, lengths.view(B, K)[:, 0].tolist())]
@@ -1,12 +1,18 @@
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
-from sklearn.model_selection import train_test_split
 import unicodedata
 import contractions
 from datasets import load_dataset, concatenate_datasets
 import re
 import os
+import sys
+import itertools
+from parallel_clean import parallel_apply, word_lengths
+from parquet_shards import ShardedParquetWriter, SPLITS, assign_splits
+from filter_rules import FilterEngine
+
+DEFAULT_FILTER_CONFIG_PATH = './Configurations/data_filter_config.json'
 
 ## requirements
 # !pip -q install contractions
@@ -26,25 +32,43 @@ def download_data():
 
     return pd.concat(datas, axis=0, ignore_index=True)
 
+def iter_download_batches(batch_size=200_000):
+    ## same rows and order as download_data(), batch_size rows at a time:
+    ## the datasets stay memory-mapped Arrow files on disk instead of one whole-corpus DataFrame
+    ds_opus = load_dataset("Helsinki-NLP/opus-100", "ar-en")
+    for batch in ds_opus['train'].iter(batch_size=batch_size):
+        yield pd.DataFrame(batch['translation'])[['en', 'ar']]
+
+    ds_covo = load_dataset("ymoslem/CoVoST2-EN-AR", "ar-en", columns=['sentence', 'translation'])
+    ds_covo = concatenate_datasets([ds_covo['train'], ds_covo['validation'], ds_covo['test']])
+    for batch in ds_covo.iter(batch_size=batch_size):
+        yield pd.DataFrame(batch).rename(columns={'translation': 'en', 'sentence': 'ar',})[['en', 'ar']]
+
 # https://stackoverflow.com/a/518232/2809427
+## combining marks (category 'Mn'), looked up once: the filtering loop then runs in C (no category() call per character)
+MN_CHARS = frozenset(chr(cp) for cp in range(sys.maxunicode + 1) if unicodedata.category(chr(cp)) == 'Mn')
 def unicodeToAscii(s):
-    return ''.join(c for c in unicodedata.normalize('NFD', s) if unicodedata.category(c) != 'Mn')
+    return ''.join(itertools.filterfalse(MN_CHARS.__contains__, unicodedata.normalize('NFD', s)))
+
+## Precompiled patterns, compiled once per process
+AR_NOT_ALLOWED = re.compile(r"[^؀-ۿ0-9.!؟،؛:\-()\"' ]+")
+EN_NOT_ALLOWED = re.compile(r"[^a-z0-9?.!,¿:;'\"\-() ]+")
 
 def clean_ar(text):
     text = unicodeToAscii(text) # Remove diacritics "التشكيل"
     text = text.replace(",", "،")
     text = text.replace(".", "۔")
     text = text.replace("?", "؟")
-    text = re.sub(r"[;:]", "؛", text)
-    text = re.sub(r"[^؀-ۿ0-9.!؟،؛:\-()\"' ]+", " ", text)
-    text = re.sub(r'\s+', ' ', text).strip() # Trim multiple whitespaces to one
+    text = text.replace(";", "؛").replace(":", "؛")
+    text = AR_NOT_ALLOWED.sub(" ", text)
+    text = ' '.join(text.split()) # Trim multiple whitespaces to one (same as re.sub(r'\s+', ' ', text).strip())
     return text
 
 def clean_en(text):
     text = text.lower()
     text = contractions.fix(text) # Fix contractions "it's" -> "it is"
-    text = re.sub(r"[^a-z0-9?.!,¿:;'\"\-() ]+", " ", text)
-    text = re.sub(r'\s+', ' ', text).strip() # Trim multiple whitespaces to one
+    text = EN_NOT_ALLOWED.sub(" ", text)
+    text = ' '.join(text.split()) # Trim multiple whitespaces to one (same as re.sub(r'\s+', ' ', text).strip())
     return text
 
 def pre_plot(plots_dir, df_data):
@@ -70,41 +94,12 @@ def pre_plot(plots_dir, df_data):
     # Close the plot to prevent it from displaying
     plt.close(fig)
 
-def drop(df_data, maxlen):
+def drop(df_data, filter_engine:FilterEngine):
     ### Personal effort (No Reference)
-    indices_to_drop = []
-
-    idx = (df_data[(df_data['ar_length'].isin([1])) | 
-                    (df_data['en_length'] == 1)]).index
-    indices_to_drop += list(idx)
-
-    idx = df_data[(df_data['en_length'] > maxlen) | 
-                    (df_data['ar_length'] > maxlen)].index
-    indices_to_drop += list(idx)
-
-    idx = (df_data[(df_data['ar_length'].isin([2])) & 
-                (df_data['en_length'] > 7)]).index
-    indices_to_drop += list(idx)
-
-    idx = (df_data[(df_data['ar_length'].isin([3])) & 
-                (df_data['en_length'] > 12)]).index
-    indices_to_drop += list(idx)
-
-    idx = (df_data[abs(df_data['ar_length'] - df_data['en_length']) > 10]).index
-    indices_to_drop += list(idx)
-
-    indices_to_drop = list(set(indices_to_drop)) + [681448, 503657]
-
-    filtered_data = df_data.drop(indices_to_drop).reset_index(drop=True)
-
-    # df_data = df_data.drop_duplicates(keep='first', subset='ar')
-    filtered_data = filtered_data.drop_duplicates(keep='first', subset='en')
-
-    filtered_data = filtered_data.replace('', pd.NA).dropna()
-    filtered_data = filtered_data.replace(' ', pd.NA).dropna()
-    filtered_data.isna().sum()
-
-    return filtered_data
+    ## The rules (lengths, length gap, hand-picked rows, 'en' duplicates, empty sentences) are declared in
+    ## Configurations/data_filter_config.json and evaluated as one mask per batch by the FilterEngine.
+    ## df_data keeps its global row index so the hand-picked rows are found batch by batch.
+    return filter_engine.apply(df_data).reset_index(drop=True)
 
 def post_plot(plots_dir, filtered_data):
 
@@ -136,27 +131,41 @@ def post_plot(plots_dir, filtered_data):
     # Close the plot to prevent it from displaying
     plt.close(fig)
 
-def ar_en_data(data_dir, plots_dir, maxlen, valid_test_split, seed):
-
-    df_data = download_data()
-    df_data['en'] = df_data['en'].apply(clean_en)
-    df_data['ar'] = df_data['ar'].apply(clean_ar)
-    df_data['en_length'] = df_data['en'].apply(lambda x: len(x.split(' ')))
-    df_data['ar_length'] = df_data['ar'].apply(lambda x: len(x.split(' ')))
-
-    pre_plot(plots_dir, df_data)
-    filtered_data = drop(df_data, maxlen)
-    post_plot(plots_dir, filtered_data)
-
-    df_train, df_test = train_test_split(filtered_data, test_size=valid_test_split, shuffle=True, random_state=seed)
-    df_valid, df_test = train_test_split(df_test, test_size=0.5, shuffle=True, random_state=seed)
-    print(df_train.shape, df_test.shape, df_valid.shape, sep=', ')
-
-    df_train.to_csv(os.path.join(data_dir,'en-ar_train.csv'), index=False)
-    df_valid.to_csv(os.path.join(data_dir,'en-ar_valid.csv'), index=False)
-    df_test.to_csv(os.path.join(data_dir,'en-ar_test.csv'), index=False)
-
-    return df_train, df_valid, df_test
-
-
-
+def ar_en_data(data_dir, plots_dir, maxlen, valid_test_split, seed, num_workers=0,
+               batch_size=200_000, rows_per_shard=500_000, filter_config_path=DEFAULT_FILTER_CONFIG_PATH):
+    ## Out-of-core build: the corpus goes through download -> clean -> drop -> split batch by batch,
+    ## and every split is written as a directory of Parquet shards (en, ar, en_length, ar_length).
+    ## Only the length columns (for the plots) and the 64-bit hashes of the kept 'en' sentences (deduplication) stay in memory.
+    rng = np.random.default_rng(seed)
+    split_dirs = {split: os.path.join(data_dir, f'en-ar_{split}') for split in SPLITS}
+    writers = {split: ShardedParquetWriter(split_dir, rows_per_shard, seed) for split, split_dir in split_dirs.items()}
+    filter_engine = FilterEngine(filter_config_path, params={'maxlen': maxlen})
+    pre_lengths, post_lengths = [], []
+    row_offset = 0
+    for df_data in iter_download_batches(batch_size):
+        df_data.index = pd.RangeIndex(row_offset, row_offset + len(df_data))
+        row_offset += len(df_data)
+        ## chunked cleaning over a process pool (num_workers=0: all cores)
+        df_data['en'] = parallel_apply(clean_en, df_data['en'], num_workers)
+        df_data['ar'] = parallel_apply(clean_ar, df_data['ar'], num_workers)
+        df_data['en_length'] = word_lengths(df_data['en'])
+        df_data['ar_length'] = word_lengths(df_data['ar'])
+        pre_lengths.append(df_data[['en_length', 'ar_length']].astype(np.int32))
+
+        filtered_data = drop(df_data, filter_engine)
+        post_lengths.append(filtered_data[['en_length', 'ar_length']].astype(np.int32))
+
+        ## rows are assigned to train/valid/test independently, the writers shuffle every split across its shards on close
+        splits = assign_splits(rng, len(filtered_data), valid_test_split)
+        for split, writer in writers.items():
+            writer.write(filtered_data[splits == split])
+
+    for writer in writers.values():
+        writer.close()
+    print(filter_engine.report())
+    print(*[f"{split}: {writer.num_rows:,} rows in {writer.num_shards} shards" for split, writer in writers.items()], sep=', ')
+
+    pre_plot(plots_dir, pd.concat(pre_lengths, ignore_index=True))
+    post_plot(plots_dir, pd.concat(post_lengths, ignore_index=True))
+
+    return split_dirs['train'], split_dirs['valid'], split_dirs['test']
@@ -1,5 +1,5 @@
 import argparse
-from ar_en_data_make import ar_en_data
+from ar_en_data_make import ar_en_data, DEFAULT_FILTER_CONFIG_PATH
 import os
 
 #####-----Parameters-----#####
@@ -18,6 +18,9 @@ def parse_arguments():
     parser.add_argument('--maxlen', type=int, default=DEFAULT_MAXLEN, help='maximum length of words for one example')
     parser.add_argument('--seed', type=int, default=DEFAULT_SEED, help='Random seed')
     parser.add_argument('--valid_test_split', type=float, default=DEFAULT_VALID_TEST_SPLIT, help='source character coverage')
+    parser.add_argument('--num_workers', type=int, default=0, help='Processes used for cleaning (0: all cores)')
+    parser.add_argument('--rows_per_shard', type=int, default=500_000, help='Maximum number of rows of a Parquet shard')
+    parser.add_argument('--filter_config_path', type=str, default=DEFAULT_FILTER_CONFIG_PATH, help='Path to the filter rules config file')
 
     return parser
  
@@ -34,4 +37,6 @@ if __name__ == '__main__':
 
 
     # Call the function with the parsed arguments
-    df_train, df_valid, df_test = ar_en_data(data_dir, plots_dir, args.maxlen, args.valid_test_split, args.seed)
\ No newline at end of file
+    train_dir, valid_dir, test_dir = ar_en_data(data_dir, plots_dir, args.maxlen, args.valid_test_split, args.seed, args.num_workers,
+                                               rows_per_shard=args.rows_per_shard,
+                                               filter_config_path=args.filter_config_path)
\ No newline at end of file
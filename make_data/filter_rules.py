@@ -0,0 +1,137 @@
+import json
+import os
+import numpy as np
+import pandas as pd
+
+## Config-declared filtering of a corpus processed batch by batch (see Configurations/data_filter_config.json):
+##   rules              a row is dropped when all the conditions of any rule hold, evaluated as one combined mask
+##                      condition: {"column": c | "abs_diff": [c1, c2] | "ratio": [c1, c2], "op": "==" ... "<=", "value": v}
+##                      a string value is looked up in the params given to FilterEngine (e.g. "maxlen")
+##   drop_rows          global row ids to drop
+##   dedup_columns      keep the first row of every distinct value of these columns (64-bit hashes, across batches)
+##   drop_empty_columns drop rows where one of these columns is missing or blank
+
+OPS = {'==': np.equal, '!=': np.not_equal, '>': np.greater, '>=': np.greater_equal, '<': np.less, '<=': np.less_equal}
+
+
+class HashDeduper():
+    """
+    Streaming exact-duplicate filter over 64-bit row hashes.
+
+    Only the hashes of the rows kept so far are stored (8 bytes per distinct row), as O(log n) sorted runs
+    merged geometrically (a run is merged into the previous one while that one is at most twice its size),
+    membership of a whole batch is one vectorized searchsorted per run.
+    """
+    def __init__(self, columns:list):
+        self.columns = columns
+        self.runs = []
+
+    @staticmethod
+    def _in_run(run, hashes):
+        positions = np.searchsorted(run, hashes).clip(max=len(run) - 1)
+        return run[positions] == hashes
+
+    def keep_mask(self, df:pd.DataFrame):
+        hashes = pd.util.hash_pandas_object(df[self.columns], index=False).to_numpy()
+        ## first occurrence inside the batch
+        _, first_index = np.unique(hashes, return_index=True)
+        keep = np.zeros(len(df), dtype=bool)
+        keep[first_index] = True
+        ## not seen in a previous batch
+        for run in self.runs:
+            keep &= ~self._in_run(run, hashes)
+        new_run = np.sort(hashes[keep])
+        if len(new_run) == 0:
+            return keep
+        while self.runs and len(self.runs[-1]) <= 2 * len(new_run):
+            new_run = np.sort(np.concatenate([self.runs.pop(), new_run]), kind='mergesort')
+        self.runs.append(new_run)
+        return keep
+
+
+class FilterEngine():
+    """
+    Applies the rules of a data filter config to DataFrame batches and counts the drops of every rule.
+
+    Args:
+        config_path (str): Path of the JSON filter configuration.
+        params (dict): Values of the string placeholders used in the rules (e.g. {"maxlen": 25}).
+    """
+    def __init__(self, config_path:str, params:dict=None):
+        assert os.path.exists(config_path), f"{config_path} : filter configuration file not found."
+        with open(config_path, 'r') as file:
+            config = json.load(file)
+        params = params or {}
+
+        self.rules = config.get("rules", [])
+        assert isinstance(self.rules, list), "rules must be a list."
+        for rule in self.rules:
+            assert isinstance(rule.get("name"), str), "every rule must have a name."
+            assert rule.get("conditions"), f"rule {rule['name']} has no conditions."
+            for condition in rule["conditions"]:
+                assert condition.get("op") in OPS, f"rule {rule['name']}: op must be one of {list(OPS)}."
+                assert sum(key in condition for key in ("column", "abs_diff", "ratio")) == 1, \
+                    f"rule {rule['name']}: a condition needs exactly one of column, abs_diff or ratio."
+                if isinstance(condition["value"], str):
+                    assert condition["value"] in params, f"rule {rule['name']}: unknown parameter {condition['value']}."
+                    condition["value"] = params[condition["value"]]
+
+        self.drop_rows = config.get("drop_rows", [])
+        assert isinstance(self.drop_rows, list), "drop_rows must be a list."
+        self.dedup_columns = config.get("dedup_columns", [])
+        assert isinstance(self.dedup_columns, list), "dedup_columns must be a list."
+        self.drop_empty_columns = config.get("drop_empty_columns", [])
+        assert isinstance(self.drop_empty_columns, list), "drop_empty_columns must be a list."
+
+        self.deduper = HashDeduper(self.dedup_columns) if self.dedup_columns else None
+        self.counts = {rule["name"]: 0 for rule in self.rules}
+        self.counts.update({'drop_rows': 0, 'duplicates': 0, 'empty': 0})
+        self.num_rows = 0
+        self.num_kept = 0
+
+    @staticmethod
+    def _operand(df, condition):
+        if "column" in condition:
+            return df[condition["column"]].to_numpy()
+        if "abs_diff" in condition:
+            a, b = condition["abs_diff"]
+            return np.abs(df[a].to_numpy() - df[b].to_numpy())
+        a, b = condition["ratio"]
+        return df[a].to_numpy() / np.maximum(df[b].to_numpy(), 1)
+
+    def apply(self, df:pd.DataFrame):
+        ## df keeps its global row ids as index (used by drop_rows)
+        self.num_rows += len(df)
+        drop_mask = np.zeros(len(df), dtype=bool)
+        for rule in self.rules:
+            rule_mask = np.ones(len(df), dtype=bool)
+            for condition in rule["conditions"]:
+                rule_mask &= OPS[condition["op"]](self._operand(df, condition), condition["value"])
+            self.counts[rule["name"]] += int(rule_mask.sum())
+            drop_mask |= rule_mask
+        if self.drop_rows:
+            rows_mask = df.index.isin(self.drop_rows)
+            self.counts['drop_rows'] += int(rows_mask.sum())
+            drop_mask |= rows_mask
+        filtered = df[~drop_mask]
+
+        if self.deduper is not None:
+            keep = self.deduper.keep_mask(filtered)
+            self.counts['duplicates'] += int((~keep).sum())
+            filtered = filtered[keep]
+
+        if self.drop_empty_columns:
+            empty = np.zeros(len(filtered), dtype=bool)
+            for column in self.drop_empty_columns:
+                empty |= (filtered[column].isna() | filtered[column].astype(str).str.strip().eq('')).to_numpy()
+            self.counts['empty'] += int(empty.sum())
+            filtered = filtered[~empty]
+
+        self.num_kept += len(filtered)
+        return filtered
+
+    def report(self):
+        ## rule counts overlap: a row matching several rules is counted by each of them
+        lines = [f"Filtered {self.num_rows:,} rows, kept {self.num_kept:,} ({self.num_rows - self.num_kept:,} dropped)"]
+        lines += [f"  {name:<25}{count:>12,}" for name, count in self.counts.items()]
+        return '\n'.join(lines)
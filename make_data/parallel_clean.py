@@ -0,0 +1,39 @@
+import os
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+## Chunked process-pool cleaning shared by the make_data pipelines.
+## func must be a module level function (it is pickled by reference to the worker processes).
+
+
+def _apply_chunk(args):
+    func, texts = args
+    return [func(text) for text in texts]
+
+
+def parallel_apply(func, texts, num_workers=0, chunk_size=20_000):
+    """
+    Apply func to every text, chunk_size texts per task over a pool of num_workers processes.
+
+    Args:
+        func (Callable[[str], str]): Module level cleaning function.
+        texts (Iterable[str]): Texts to clean (a list or a pandas Series).
+        num_workers (int): Number of processes, 0 = all cores, 1 = no pool. Default is 0.
+        chunk_size (int): Number of texts per task. Default is 20,000.
+
+    Returns:
+        List[str]: Cleaned texts, in the input order.
+    """
+    texts = list(texts)
+    num_workers = num_workers or os.cpu_count() or 1
+    if num_workers == 1 or len(texts) <= chunk_size:
+        return _apply_chunk((func, texts))
+
+    chunks = [(func, texts[i:i+chunk_size]) for i in range(0, len(texts), chunk_size)]
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        return [text for chunk in executor.map(_apply_chunk, chunks) for text in chunk]
+
+
+def word_lengths(texts:pd.Series):
+    ## same as texts.apply(lambda x: len(x.split(' '))), without a Python call per row
+    return texts.str.count(' ') + 1
@@ -0,0 +1,99 @@
+import os
+import glob
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+## Out-of-core output of the make_data pipelines: every split is a directory of Parquet shards
+## (<split_dir>/part-00000.parquet, ...), written one row group per cleaned batch, then shuffled
+## across all shards on close (the sources arrive corpus after corpus, some of them length-sorted).
+
+SPLITS = ('train', 'valid', 'test')
+
+
+class ShardedParquetWriter():
+    """
+    Appends DataFrame batches as row groups to Parquet shards of at most rows_per_shard rows.
+
+    With a seed, close() shuffles the rows across all the shards (two-pass external shuffle): every row is
+    sent to a random shard, then every shard is permuted in memory. Memory stays ~ one shard.
+
+    Args:
+        split_dir (str): Output directory of the split (existing shards are removed).
+        rows_per_shard (int): A new shard is started once the current one holds this many rows. Default is 500,000.
+        seed (int): Seed of the shuffle on close, None keeps the rows in write order. Default is None.
+    """
+    def __init__(self, split_dir:str, rows_per_shard=500_000, seed=None):
+        assert rows_per_shard > 0, "rows_per_shard must be a positive integer."
+        self.split_dir = split_dir
+        self.rows_per_shard = rows_per_shard
+        self.seed = seed
+        os.makedirs(split_dir, exist_ok=True)
+        for path in glob.glob(os.path.join(split_dir, 'part-*.parquet')) + glob.glob(os.path.join(split_dir, 'scatter-*.tmp')):
+            os.remove(path)
+        self.writer = None
+        self.num_shards = 0
+        self.shard_rows = 0
+        self.num_rows = 0
+
+    def write(self, df:pd.DataFrame):
+        if len(df) == 0:
+            return
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        if self.writer is not None and self.shard_rows >= self.rows_per_shard:
+            self.writer.close()
+            self.writer = None
+        if self.writer is None:
+            self.writer = pq.ParquetWriter(self._shard_path(self.num_shards), table.schema)
+            self.num_shards += 1
+            self.shard_rows = 0
+        self.writer.write_table(table)
+        self.shard_rows += len(df)
+        self.num_rows += len(df)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+            if self.seed is not None:
+                self._shuffle()
+
+    def _shard_path(self, index):
+        return os.path.join(self.split_dir, f'part-{index:05d}.parquet')
+
+    def _shuffle(self):
+        rng = np.random.default_rng(self.seed)
+        ## pass 1: every row goes to one of num_shards scatter files, chosen at random
+        ## (scatter files are .tmp so a reader never picks them up)
+        scatter_paths = [os.path.join(self.split_dir, f'scatter-{i:05d}.tmp') for i in range(self.num_shards)]
+        scatter_writers = [None] * self.num_shards
+        for shard in range(self.num_shards):
+            parquet_file = pq.ParquetFile(self._shard_path(shard))
+            for row_group in range(parquet_file.num_row_groups):
+                table = parquet_file.read_row_group(row_group)
+                destinations = rng.integers(self.num_shards, size=table.num_rows)
+                table = table.take(np.argsort(destinations, kind='stable'))
+                counts = np.bincount(destinations, minlength=self.num_shards)
+                starts = np.cumsum(counts) - counts
+                for i in np.flatnonzero(counts):
+                    if scatter_writers[i] is None:
+                        scatter_writers[i] = pq.ParquetWriter(scatter_paths[i], table.schema)
+                    scatter_writers[i].write_table(table.slice(starts[i], counts[i]))
+            os.remove(self._shard_path(shard))
+        ## pass 2: every scatter file is permuted in memory and becomes a shard
+        self.num_shards = 0
+        for path, writer in zip(scatter_paths, scatter_writers):
+            if writer is None:
+                continue
+            writer.close()
+            table = pq.read_table(path)
+            pq.write_table(table.take(rng.permutation(table.num_rows)), self._shard_path(self.num_shards))
+            os.remove(path)
+            self.num_shards += 1
+
+
+def assign_splits(rng:np.random.Generator, num_rows:int, valid_test_split:float):
+    ## per row split, same proportions as train_test_split(valid_test_split) then an even valid/test split
+    u = rng.random(num_rows)
+    return np.where(u < 1 - valid_test_split, 'train', np.where(u < 1 - valid_test_split / 2, 'valid', 'test'))
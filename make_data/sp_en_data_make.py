@@ -1,13 +1,38 @@
 import keras
 import pathlib
 import string
+import numpy as np
 import pandas as pd
-from sklearn.model_selection import train_test_split
 import re
 import os
+from parallel_clean import parallel_apply, word_lengths
+from parquet_shards import ShardedParquetWriter, SPLITS, assign_splits
 
 
-def sp_en_data(data_dir, valid_test_split, seed):
+strip_chars = string.punctuation + "¿"
+strip_chars = strip_chars.replace("[", "")
+strip_chars = strip_chars.replace("]", "")
+STRIP_CHARS = re.compile("[%s]" % re.escape(strip_chars))
+
+def custom_standardization(input_string):
+    lowercase = input_string.lower()
+    return STRIP_CHARS.sub("", lowercase)
+
+
+def iter_line_batches(text_file, batch_size):
+    with open(text_file) as f:
+        batch = []
+        for line in f:
+            line = line.rstrip("\n")
+            if not line: continue
+            batch.append(line)
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if batch: yield batch
+
+
+def sp_en_data(data_dir, valid_test_split, seed, num_workers=0, batch_size=200_000, rows_per_shard=500_000):
 
     text_file = keras.utils.get_file(
         fname="spa-eng.zip",
@@ -16,30 +41,26 @@ def sp_en_data(data_dir, valid_test_split, seed):
     
     text_file = pathlib.Path(text_file).parent / "spa-eng" / "spa.txt"
 
-    strip_chars = string.punctuation + "¿"
-    strip_chars = strip_chars.replace("[", "")
-    strip_chars = strip_chars.replace("]", "")
-    def custom_standardization(input_string):
-        lowercase = input_string.lower()
-        return re.sub("[%s]" % re.escape(strip_chars), "", lowercase)
-
-    with open(text_file) as f:
-        lines = f.read().split("\n")[:-1]
-    text_pairs = []
-    for line in lines:
-        eng, spa = line.split("\t")
-        text_pairs.append((eng.lower(), custom_standardization(spa)))
-
+    ## Out-of-core build: the file is cleaned and split batch_size lines at a time, and every split
+    ## is written as a directory of Parquet shards (en, sp, en_length, sp_length)
+    rng = np.random.default_rng(seed)
+    split_dirs = {split: os.path.join(data_dir, f'en-sp_{split}') for split in SPLITS}
+    writers = {split: ShardedParquetWriter(split_dir, rows_per_shard, seed) for split, split_dir in split_dirs.items()}
+    for lines in iter_line_batches(text_file, batch_size):
+        eng_texts, spa_texts = zip(*(line.split("\t") for line in lines))
+        ## chunked cleaning over a process pool (num_workers=0: all cores)
+        df_pairs = pd.DataFrame({'en': [text.lower() for text in eng_texts],
+                                 'sp': parallel_apply(custom_standardization, spa_texts, num_workers)})
+        df_pairs['en_length'] = word_lengths(df_pairs['en'])
+        df_pairs['sp_length'] = word_lengths(df_pairs['sp'])
 
-    train_pairs, test_pairs = train_test_split(text_pairs, test_size=valid_test_split, shuffle=True, random_state=seed)
-    val_pairs, test_pairs = train_test_split(test_pairs, test_size=0.5, shuffle=True, random_state=seed)
+        ## rows are assigned to train/valid/test independently, the writers shuffle every split across its shards on close
+        splits = assign_splits(rng, len(df_pairs), valid_test_split)
+        for split, writer in writers.items():
+            writer.write(df_pairs[splits == split])
 
-    df_train = pd.DataFrame(train_pairs, columns=['en', 'sp'])
-    df_valid = pd.DataFrame(val_pairs, columns=['en', 'sp'])
-    df_test = pd.DataFrame(test_pairs, columns=['en', 'sp'])
-    print(df_train.shape, df_test.shape, df_valid.shape, sep=', ')
-    df_train.to_csv(os.path.join(data_dir, 'en-sp_train.csv'), index=False)
-    df_valid.to_csv(os.path.join(data_dir, 'en-sp_valid.csv'), index=False)
-    df_test.to_csv(os.path.join(data_dir, 'en-sp_test.csv'), index=False)
+    for writer in writers.values():
+        writer.close()
+    print(*[f"{split}: {writer.num_rows:,} rows in {writer.num_shards} shards" for split, writer in writers.items()], sep=', ')
 
-    return df_train, df_valid, df_test
\ No newline at end of file
+    return split_dirs['train'], split_dirs['valid'], split_dirs['test']
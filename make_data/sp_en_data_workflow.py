@@ -14,6 +14,8 @@ def parse_arguments():
     parser.add_argument('--out_dir', required=True, help='Working dir')
     parser.add_argument('--seed', type=int, default=DEFAULT_SEED, help='Random seed')
     parser.add_argument('--valid_test_split', type=float, default=DEFAULT_VALID_TEST_SPLIT, help='source character coverage')
+    parser.add_argument('--num_workers', type=int, default=0, help='Processes used for cleaning (0: all cores)')
+    parser.add_argument('--rows_per_shard', type=int, default=500_000, help='Maximum number of rows of a Parquet shard')
 
     return parser
  
@@ -27,4 +29,5 @@ if __name__ == '__main__':
     os.makedirs(data_dir, exist_ok=True)
 
     # Call the function with the parsed arguments
-    df_train, df_valid, df_test = sp_en_data(data_dir, args.valid_test_split, args.seed)
\ No newline at end of file
+    train_dir, valid_dir, test_dir = sp_en_data(data_dir, args.valid_test_split, args.seed, args.num_workers,
+                                                rows_per_shard=args.rows_per_shard)
\ No newline at end of file
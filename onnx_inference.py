@@ -0,0 +1,48 @@
+import numpy as np
+import onnxruntime as ort
+
+## PyTorch-free greedy decoding over the two graphs written by save_checkpoint(..., in_onnx=True)
+## (Models/OnnxExport.py): <run_name>_encoder.onnx and <run_name>_decoder_step.onnx
+
+
+class OnnxGreedyDecoder():
+    def __init__(self, encoder_path, decoder_step_path, providers=None, num_threads=0):
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = num_threads # 0 = onnxruntime default
+        providers = providers or ['CPUExecutionProvider']
+        self.encoder = ort.InferenceSession(encoder_path, options, providers=providers)
+        self.decoder_step = ort.InferenceSession(decoder_step_path, options, providers=providers)
+        self.state_names = [output.name for output in self.encoder.get_outputs()]
+        self.decoder_inputs = [graph_input.name for graph_input in self.decoder_step.get_inputs()]
+        self.decoder_outputs = [output.name for output in self.decoder_step.get_outputs()]
+
+    def greedy_decode_batch(self, source:np.ndarray, sos_tokenId:int, eos_tokenId:int, pad_tokenId, max_tries=50):
+        ## source: padded int64 batch of shape (B, Ts)
+        ## returns one token list per row (<s> ... </s>) with the padding stripped, like utils.greedy_decode_batch
+        source = np.asarray(source, dtype=np.int64)
+        B = source.shape[0]
+        state = dict(zip(self.state_names, self.encoder.run(self.state_names, {'source': source})))
+        step_tokens = np.full((B, 1), sos_tokenId, dtype=np.int64)
+        targets_hat = [step_tokens]
+        finished = np.zeros(B, dtype=bool)
+        lengths = np.full(B, max_tries+1, dtype=np.int64)
+        for step in range(max_tries):
+            feed = {name: state[name] for name in self.decoder_inputs if name != 'last_tokens'}
+            feed['last_tokens'] = step_tokens
+            outputs = dict(zip(self.decoder_outputs, self.decoder_step.run(self.decoder_outputs, feed)))
+            for name, value in outputs.items():
+                if name.startswith('new_'): state[name[len('new_'):]] = value
+            ## rows that already emitted </s> keep emitting <pad>
+            step_tokens = outputs['logits'].argmax(-1).astype(np.int64).reshape(B, 1)
+            step_tokens[finished] = pad_tokenId
+            targets_hat.append(step_tokens)
+            just_finished = ~finished & (step_tokens[:, 0] == eos_tokenId)
+            lengths[just_finished] = step+2
+            finished = finished | just_finished
+            if finished.all():
+                break
+        targets_hat = np.concatenate(targets_hat, axis=1).tolist()
+        return [row[:length] for row, length in zip(targets_hat, lengths.tolist())]
+
+    def greedy_decode(self, source_tokens:list, sos_tokenId:int, eos_tokenId:int, pad_tokenId, max_tries=50):
+        return self.greedy_decode_batch(np.array([source_tokens], dtype=np.int64), sos_tokenId, eos_tokenId, pad_tokenId, max_tries)[0]
@@ -0,0 +1,109 @@
+import torch
+import copy
+import io
+import time
+import os
+import argparse
+import sys
+from Models.AutoModel import get_model, quantize_model
+from Models.ModelArgs import ModelArgs
+from Tokenizers.Tokenizers import Callable_tokenizer, read_text_chunks
+from utils import greedy_decode_batch
+from nltk.translate.bleu_score import corpus_bleu, SmoothingFunction
+
+
+# Command-Line Arguments
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Dynamic int8 quantization of a trained checkpoint for CPU serving')
+
+    parser.add_argument('--checkpoint_path', type=str, required=True, help='A path of the trained fp32 .pth checkpoint')
+    parser.add_argument('--model_config_path', type=str, required=True, help='A path for model configuration file')
+    parser.add_argument('--model_type', type=str, required=True, choices=['s2s', 's2sAttention', 'transformer'],
+                        help='A type of model (choices: s2s, s2sAttention, transformer)')
+    parser.add_argument('--tokenizer_path', type=str, required=True, help='A path of tokenizer.model')
+    parser.add_argument('--test_csv_path', type=str, required=True, help='CSV (or Parquet file / directory of Parquet shards) of columns used for the comparison report')
+    parser.add_argument('--source_column_name', type=str, required=True, help='source_column_name')
+    parser.add_argument('--target_column_name', type=str, required=True, help='target_column_name')
+    parser.add_argument('--out_dir', type=str, required=True, help='A path for output directory')
+    parser.add_argument('--num_samples', type=int, default=500, help='Number of test sentences used for the report')
+    parser.add_argument('--max_tries', type=int, default=50, help='Maximum number of decoded tokens per sentence')
+
+    return parser
+
+
+def evaluate_cpu(model, tokenizer, sources, references, max_tries):
+    sos = tokenizer.get_tokenId('<s>')
+    eos = tokenizer.get_tokenId('</s>')
+    pad = tokenizer.get_tokenId('<pad>')
+    hypotheses = []
+    total_time = 0.0
+    for source in sources:
+        source_tensor = torch.tensor(tokenizer(source))
+        start = time.perf_counter()
+        target_tokens = greedy_decode_batch(model, source_tensor.unsqueeze(0), sos, eos, pad, max_tries)[0]
+        total_time += time.perf_counter() - start
+        hypotheses.append(tokenizer.decode(target_tokens).split())
+    bleu = corpus_bleu([[reference.split()] for reference in references], hypotheses,
+                       smoothing_function=SmoothingFunction().method2)
+    return {'latency_ms': total_time / len(sources) * 1000, 'bleu': bleu}
+
+
+def weights_size_mb(model):
+    ## size of a weights-only checkpoint of model (the training checkpoints also hold the optimizer and training state)
+    buffer = io.BytesIO()
+    torch.save({'model_state_dict': model.state_dict()}, buffer)
+    return buffer.getbuffer().nbytes / 2**20
+
+
+if __name__ == '__main__':
+    # Argument parsing and validation
+    parser = parse_arguments()
+    if len(sys.argv) > 1:
+        args = parser.parse_args()
+    else:
+        parser.error("No argument provided!")
+
+    assert os.path.exists(args.checkpoint_path), f"{args.checkpoint_path} : Checkpoint not found."
+    assert os.path.exists(args.model_config_path), f"{args.model_config_path} : Model configuration file not found."
+    assert os.path.exists(args.tokenizer_path), f"{args.tokenizer_path} : Tokenizer.model not found."
+    assert os.path.exists(args.test_csv_path), f"{args.test_csv_path} : Test csv not found."
+    save_models_dir = os.path.join(args.out_dir, 'models')
+    os.makedirs(save_models_dir, exist_ok=True)
+
+    print("---------------------Loading fp32 model...---------------------")
+    tokenizer = Callable_tokenizer(args.tokenizer_path)
+    model_args = ModelArgs(model_type=args.model_type, config_path=args.model_config_path)
+    model = get_model(model_args, len(tokenizer))
+    model_state_dict = torch.load(args.checkpoint_path, map_location='cpu', weights_only=True)['model_state_dict']
+    model.load_state_dict(model_state_dict)
+    model.eval()
+    print("Loading Done.")
+
+    print("---------------------Quantizing...---------------------")
+    ## The int8 transformer runs on the scaled_dot_product_attention blocks (same state dict layout),
+    ## so the float weights are loaded there before quantizing, exactly as get_model(..., quantized=True) builds it.
+    flash_args = copy.copy(model_args)
+    flash_args.flash_attention = True
+    qmodel = get_model(flash_args, len(tokenizer))
+    qmodel.load_state_dict(model_state_dict)
+    qmodel = quantize_model(qmodel.eval())
+    qmodel_path = os.path.join(save_models_dir, os.path.splitext(os.path.basename(args.checkpoint_path))[0] + '_int8.pth')
+    torch.save({'model_state_dict': qmodel.state_dict()}, qmodel_path)
+    print(f"Quantized checkpoint saved at: {qmodel_path}")
+    print("Quantization Done.")
+
+    print("---------------------Comparing fp32 vs int8...---------------------")
+    test_df = next(read_text_chunks(args.test_csv_path, [args.source_column_name, args.target_column_name],
+                                    chunk_size=2*args.num_samples)).dropna().head(args.num_samples)
+    sources = test_df[args.source_column_name].to_list()
+    references = test_df[args.target_column_name].to_list()
+    fp32_report = evaluate_cpu(model, tokenizer, sources, references, args.max_tries)
+    int8_report = evaluate_cpu(qmodel, tokenizer, sources, references, args.max_tries)
+    fp32_report['size_mb'] = weights_size_mb(model)
+    int8_report['size_mb'] = weights_size_mb(qmodel)
+
+    print(f"Report on {len(sources):,} sentences of {args.test_csv_path}")
+    print(f"{'Model':<10}{'Size (MB)':>15}{'Latency (ms/sent)':>20}{'BLEU':>10}")
+    for name, report in [('fp32', fp32_report), ('int8', int8_report)]:
+        print(f"{name:<10}{report['size_mb']:>15.2f}{report['latency_ms']:>20.2f}{report['bleu']:>10.4f}")
+    print("Comparison Done.")
@@ -0,0 +1,42 @@
+import glob
+import os
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+from make_data.parquet_shards import ShardedParquetWriter, SPLITS, assign_splits
+
+
+def _read_split(split_dir):
+    return pd.concat([pq.read_table(path).to_pandas() for path in sorted(glob.glob(os.path.join(split_dir, '*.parquet')))],
+                     ignore_index=True)
+
+
+def test_split_rows_are_shuffled_across_shards(tmp_path):
+    ## source order: a first corpus then a second one, like the make_data downloads
+    rng = np.random.default_rng(0)
+    writers = {split: ShardedParquetWriter(str(tmp_path / split), rows_per_shard=300, seed=0) for split in SPLITS}
+    for start in range(0, 5000, 1000):
+        batch = pd.DataFrame({'id': np.arange(start, start + 1000), 'corpus': ['a' if start < 2500 else 'b'] * 1000})
+        splits = assign_splits(rng, len(batch), 0.2)
+        for split, writer in writers.items():
+            writer.write(batch[splits == split])
+    for writer in writers.values():
+        writer.close()
+
+    ids = [_read_split(str(tmp_path / split))['id'].to_numpy() for split in SPLITS]
+    ## every row is written once, no scatter file is left behind
+    assert np.array_equal(np.sort(np.concatenate(ids)), np.arange(5000))
+    assert not glob.glob(str(tmp_path / '*' / '*.tmp'))
+    train = _read_split(str(tmp_path / 'train'))
+    assert not np.array_equal(train['id'].to_numpy(), np.sort(train['id'].to_numpy()))
+    ## the first shard already mixes both corpora
+    first_shard = pq.read_table(os.path.join(str(tmp_path / 'train'), 'part-00000.parquet')).to_pandas()
+    assert set(first_shard['corpus']) == {'a', 'b'}
+
+
+def test_no_seed_keeps_write_order(tmp_path):
+    writer = ShardedParquetWriter(str(tmp_path / 'train'), rows_per_shard=300)
+    for start in range(0, 1000, 250):
+        writer.write(pd.DataFrame({'id': np.arange(start, start + 250)}))
+    writer.close()
+    assert np.array_equal(_read_split(str(tmp_path / 'train'))['id'].to_numpy(), np.arange(1000))
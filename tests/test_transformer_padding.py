@@ -0,0 +1,21 @@
+import pytest
+import torch
+from Models.Transformer_model import NMT_Transformer
+
+PAD = 0
+
+
+@pytest.mark.parametrize("flash_attention", [False, True])
+def test_source_padding_does_not_change_decoder_outputs(flash_attention):
+    ## the decoder cross-attention ignores the padded source positions (memory_key_padding_mask)
+    torch.manual_seed(0)
+    model = NMT_Transformer(vocab_size=50, dim_embed=32, dim_model=32, dim_feedforward=64, num_layers=2,
+                            dropout_probability=0.1, maxlen=32, flash_attention=flash_attention, num_heads=4).eval()
+    source = torch.randint(4, 50, (1, 6))
+    target = torch.randint(4, 50, (1, 5))
+    padded_source = torch.cat([source, torch.full((1, 7), PAD)], dim=1)
+
+    with torch.no_grad():
+        logits, _ = model(source, target, PAD)
+        padded_logits, _ = model(padded_source, target, PAD)
+    torch.testing.assert_close(padded_logits, logits, rtol=1e-5, atol=1e-5)
@@ -1,11 +1,19 @@
 import math
+import json
+import time
+import resource
+import glob
+import random
+import hashlib
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import torch
-from torch.utils.data import Dataset
-from torch.nn.utils.rnn import pad_sequence
-from Tokenizers.Tokenizers import Callable_tokenizer
+from torch.utils.data import Dataset, IterableDataset, Sampler, get_worker_info
+from Tokenizers.Tokenizers import Callable_tokenizer, data_files, read_text_chunks
+from Models.OnnxExport import export_onnx
 import matplotlib.pyplot as plt
 import os
-from nltk.translate.bleu_score import sentence_bleu, SmoothingFunction
 
 
 ## Dataset
@@ -45,26 +53,350 @@ class MT_Dataset(Dataset):
         if self.reversed_input: input_tensor_tokens = input_tensor_tokens.flip(0)
 
         return input_tokens, target_tokens_forward#, target_tokens_loss
+
+    def lengths(self):
+        ## (source lengths, target lengths incl. <s> and </s>), used by TokenBudgetBatchSampler
+        src_lengths = np.array([len(tokens) for tokens in self.callable_tokenizer.encode_batch(self.input_sentences_list)], dtype=np.int64)
+        trg_lengths = np.array([len(tokens) + 2 for tokens in self.callable_tokenizer.encode_batch(self.target_sentences_list)], dtype=np.int64)
+        return src_lengths, trg_lengths
  
     
+## Pre-tokenized cache
+def _file_digest(hasher, path, block_size=1 << 20):
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(block_size), b''):
+            hasher.update(block)
+
+
+def build_token_cache(csv_path:str, source_column_name:str, target_column_name:str,
+                      callable_tokenizer:Callable_tokenizer, cache_dir:str, chunk_size=10_000):
+    """
+    Tokenize both columns of csv_path (CSV, Parquet file or directory of Parquet shards) once
+    and store them as flat token arrays + offsets.
+
+    The cache lives in cache_dir/<key>, where key hashes the CSV content, the column names and the tokenizer model,
+    so editing any of them builds a new cache and an existing one is reused as is.
+    Files: src_tokens.npy / trg_tokens.npy (int16 when the vocab fits, else int32, all sentences concatenated),
+    src_offsets.npy / trg_offsets.npy (int64, sentence i is tokens[offsets[i]:offsets[i+1]]) and meta.json.
+    Targets are stored with <s> ... </s> already added.
+
+    Returns:
+        str: The cache directory, to be opened with MT_TokenCacheDataset.
+    """
+    hasher = hashlib.sha1()
+    for file in data_files(csv_path):
+        _file_digest(hasher, file)
+    _file_digest(hasher, callable_tokenizer.path)
+    hasher.update(f"{source_column_name}\0{target_column_name}".encode())
+    cache_path = os.path.join(cache_dir, hasher.hexdigest()[:16])
+    if os.path.exists(os.path.join(cache_path, 'meta.json')):
+        return cache_path
+
+    dtype = np.int16 if len(callable_tokenizer) <= np.iinfo(np.int16).max else np.int32
+    sos = callable_tokenizer.get_tokenId('<s>')
+    eos = callable_tokenizer.get_tokenId('</s>')
+    src_tokens, trg_tokens = [], []
+    src_lengths, trg_lengths = [], []
+    for chunk in read_text_chunks(csv_path, [source_column_name, target_column_name], chunk_size):
+        for tokens in callable_tokenizer.encode_batch(chunk[source_column_name].to_list()):
+            src_tokens.append(np.asarray(tokens, dtype=dtype))
+            src_lengths.append(len(tokens))
+        for tokens in callable_tokenizer.encode_batch(chunk[target_column_name].to_list()):
+            trg_tokens.append(np.asarray([sos] + tokens + [eos], dtype=dtype))
+            trg_lengths.append(len(tokens) + 2)
+
+    ## write to a temporary directory first so an interrupted build never looks like a valid cache
+    tmp_path = cache_path + '.tmp'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    for side, tokens, lengths in [('src', src_tokens, src_lengths), ('trg', trg_tokens, trg_lengths)]:
+        np.save(os.path.join(tmp_path, f'{side}_tokens.npy'), np.concatenate(tokens) if tokens else np.zeros(0, dtype=dtype))
+        np.save(os.path.join(tmp_path, f'{side}_offsets.npy'), np.concatenate([[0], np.cumsum(lengths, dtype=np.int64)]))
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as file:
+        json.dump({'csv_path': csv_path, 'tokenizer_path': callable_tokenizer.path,
+                   'source_column_name': source_column_name, 'target_column_name': target_column_name,
+                   'num_pairs': len(src_lengths), 'dtype': np.dtype(dtype).name}, file, indent=4)
+    shutil.rmtree(cache_path, ignore_errors=True)
+    os.replace(tmp_path, cache_path)
+    return cache_path
+
+
+class MT_TokenCacheDataset(Dataset):
+    """
+    Dataset over a cache written by build_token_cache, returns the same items as MT_Dataset.
+
+    The arrays are memory-mapped read-only and opened lazily in each process, so DataLoader workers
+    share the page cache instead of holding their own copies of the corpus, and nothing is re-tokenized.
+
+    Args:
+        cache_path (str): Directory returned by build_token_cache.
+        reversed_input (bool): Whether to reverse the input sequence. Default is False.
+    """
+    def __init__(self, cache_path:str, reversed_input=False):
+        super(MT_TokenCacheDataset, self).__init__()
+        assert os.path.exists(os.path.join(cache_path, 'meta.json')), f"{cache_path} : token cache not found."
+
+        self.cache_path = cache_path
+        self.reversed_input = reversed_input
+        with open(os.path.join(cache_path, 'meta.json'), 'r') as file:
+            self.meta = json.load(file)
+        self.arrays = None
+
+    def _open(self):
+        self.arrays = {name: np.load(os.path.join(self.cache_path, f'{name}.npy'), mmap_mode='r')
+                       for name in ['src_tokens', 'src_offsets', 'trg_tokens', 'trg_offsets']}
+
+    def __getstate__(self):
+        ## workers re-open the memmaps instead of receiving pickled copies
+        state = self.__dict__.copy()
+        state['arrays'] = None
+        return state
+
+    def __len__(self):
+        return self.meta['num_pairs']
+
+    def __getitem__(self, index):
+        if self.arrays is None: self._open()
+        src_offsets, trg_offsets = self.arrays['src_offsets'], self.arrays['trg_offsets']
+        input_tokens = torch.from_numpy(self.arrays['src_tokens'][src_offsets[index]:src_offsets[index+1]].astype(np.int64))
+        target_tokens_forward = torch.from_numpy(self.arrays['trg_tokens'][trg_offsets[index]:trg_offsets[index+1]].astype(np.int64))
+
+        if self.reversed_input: input_tokens = input_tokens.flip(0)
+
+        return input_tokens, target_tokens_forward
+
+    def lengths(self):
+        ## (source lengths, target lengths incl. <s> and </s>), read from the offsets without touching the tokens
+        src_offsets = np.load(os.path.join(self.cache_path, 'src_offsets.npy'))
+        trg_offsets = np.load(os.path.join(self.cache_path, 'trg_offsets.npy'))
+        return np.diff(src_offsets), np.diff(trg_offsets)
+
+
+class MT_StreamingDataset(IterableDataset):
+    """
+    Streaming dataset over a CSV / Parquet shards that do not fit in memory, yields the same items as MT_Dataset.
+
+    The data is read chunk_size rows at a time, the rows of every chunk are split across the DataLoader
+    workers (row i of a chunk goes to worker i % num_workers) so each pair is produced once per pass,
+    and the pairs go through a bounded shuffle buffer. Memory stays ~ chunk_size + shuffle_buffer_size
+    pairs per worker whatever the corpus size. The shuffling follows torch's seed, so it is reproducible
+    under torch.manual_seed and different every pass.
+
+    Args:
+        csv_path (str): Path of the CSV, Parquet file or directory of Parquet shards.
+        source_column_name (str): Source column.
+        target_column_name (str): Target column.
+        callable_tokenizer (Callable): Tokenizer.
+        chunk_size (int): Rows read from the CSV at a time. Default is 10,000.
+        shuffle_buffer_size (int): Pairs held for shuffling, 0 disables shuffling. Default is 10,000.
+        reversed_input (bool): Whether to reverse the input sequence. Default is False.
+    """
+    def __init__(self, csv_path:str, source_column_name:str, target_column_name:str, callable_tokenizer:Callable_tokenizer,
+                 chunk_size=10_000, shuffle_buffer_size=10_000, reversed_input=False):
+        super(MT_StreamingDataset, self).__init__()
+        assert os.path.exists(csv_path), f"{csv_path} : csv not found."
+        assert chunk_size > 0, "chunk_size must be a positive integer."
+        assert shuffle_buffer_size >= 0, "shuffle_buffer_size must be a non-negative integer."
+
+        self.csv_path = csv_path
+        self.source_column_name = source_column_name
+        self.target_column_name = target_column_name
+        self.callable_tokenizer = callable_tokenizer
+        self.chunk_size = chunk_size
+        self.shuffle_buffer_size = shuffle_buffer_size
+        self.reversed_input = reversed_input
+        self.sos = self.callable_tokenizer.get_tokenId('<s>')
+        self.eos = self.callable_tokenizer.get_tokenId('</s>')
+
+    def _pairs(self, worker_id, num_workers):
+        for chunk in read_text_chunks(self.csv_path, [self.source_column_name, self.target_column_name], self.chunk_size):
+            chunk = chunk.iloc[worker_id::num_workers]
+            input_tokens_list = self.callable_tokenizer.encode_batch(chunk[self.source_column_name].to_list())
+            target_tokens_list = self.callable_tokenizer.encode_batch(chunk[self.target_column_name].to_list())
+            for input_tokens, target_tokens in zip(input_tokens_list, target_tokens_list):
+                input_tokens = torch.tensor(input_tokens)
+                if self.reversed_input: input_tokens = input_tokens.flip(0)
+                yield input_tokens, torch.tensor([self.sos] + target_tokens + [self.eos])
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        if worker_info is None:
+            worker_id, num_workers = 0, 1
+            ## drawn from the global generator, like the DataLoader does for the workers seeds
+            seed = int(torch.empty((), dtype=torch.int64).random_().item())
+        else:
+            worker_id, num_workers, seed = worker_info.id, worker_info.num_workers, worker_info.seed
+        pairs = self._pairs(worker_id, num_workers)
+        if self.shuffle_buffer_size == 0:
+            yield from pairs
+            return
+
+        rng = np.random.default_rng(seed)
+        buffer = []
+        for pair in pairs:
+            if len(buffer) < self.shuffle_buffer_size:
+                buffer.append(pair)
+                continue
+            ## emit a random buffered pair and keep the new one in its place
+            i = rng.integers(len(buffer))
+            yield buffer[i]
+            buffer[i] = pair
+        rng.shuffle(buffer)
+        yield from buffer
+
+
+## Batch samplers
+class EpochBatchSampler(Sampler):
+    """
+    Base of the batch samplers whose batches are a function of (seed, epoch) only,
+    so a run can resume in the middle of an epoch from its position (see set_position).
+    Subclasses implement _batches(epoch).
+    """
+    def __init__(self, shuffle=True, seed=0):
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        self.skip_batches = 0
+        self._cached_epoch, self._cached_batches = None, None
+
+    def _batches(self, epoch):
+        raise NotImplementedError
+
+    def _epoch_batches(self, epoch):
+        ## the batches of the last requested epoch are kept, len(dataloader) then costs nothing
+        if self._cached_epoch != epoch:
+            self._cached_epoch, self._cached_batches = epoch, self._batches(epoch)
+        return self._cached_batches
+
+    def set_position(self, epoch:int, batches_done:int):
+        ## the next __iter__ replays epoch and skips the batches_done first batches (no data is loaded for them)
+        self.epoch = epoch
+        self.skip_batches = batches_done
+
+    def __iter__(self):
+        batches = self._epoch_batches(self.epoch)[self.skip_batches:]
+        self.epoch += 1
+        self.skip_batches = 0
+        return iter(batches)
+
+    def __len__(self):
+        return len(self._epoch_batches(self.epoch))
+
+
+class RandomBatchSampler(EpochBatchSampler):
+    """
+    Fixed size batches of a random permutation drawn from seed + epoch, to be passed as DataLoader(batch_sampler=...).
+
+    Args:
+        num_examples (int): Number of examples of the dataset.
+        batch_size (int): Examples per batch (the last batch of an epoch may be smaller).
+        shuffle (bool): Whether to shuffle the examples every epoch. Default is True.
+        seed (int): Seed of the shuffling. Default is 0.
+    """
+    def __init__(self, num_examples:int, batch_size:int, shuffle=True, seed=0):
+        assert batch_size > 0, "batch_size must be a positive integer."
+        super(RandomBatchSampler, self).__init__(shuffle, seed)
+        self.num_examples = num_examples
+        self.batch_size = batch_size
+
+    def _batches(self, epoch):
+        if self.shuffle:
+            order = np.random.default_rng(self.seed + epoch).permutation(self.num_examples)
+        else:
+            order = np.arange(self.num_examples)
+        order = order.tolist()
+        return [order[i:i+self.batch_size] for i in range(0, self.num_examples, self.batch_size)]
+
+
+class TokenBudgetBatchSampler(EpochBatchSampler):
+    """
+    Length-bucketed batches under a padded-token budget, to be passed as DataLoader(batch_sampler=...).
+
+    Examples are grouped into buckets of similar length (max of source/target length // bucket_width),
+    and consecutive examples of the length-sorted order are packed while
+    batch_size * longest sequence of the batch stays <= max_tokens.
+    With shuffle=True the order inside each bucket and the order of the batches are reshuffled every epoch
+    from seed + epoch, so a run is reproducible for a given seed.
+
+    Args:
+        src_lengths (np.ndarray): Source length of every example.
+        trg_lengths (np.ndarray): Target length of every example.
+        max_tokens (int): Token budget of a padded batch (a longer single example still gets its own batch).
+        bucket_width (int): Width of a length bucket. Default is 8.
+        shuffle (bool): Whether to shuffle the batches every epoch. Default is True.
+        seed (int): Seed of the shuffling. Default is 0.
+    """
+    def __init__(self, src_lengths, trg_lengths, max_tokens:int, bucket_width=8, shuffle=True, seed=0):
+        assert len(src_lengths) == len(trg_lengths), "src_lengths and trg_lengths must have the same length."
+        assert max_tokens > 0, "max_tokens must be a positive integer."
+        assert bucket_width > 0, "bucket_width must be a positive integer."
+        super(TokenBudgetBatchSampler, self).__init__(shuffle, seed)
+        self.lengths = np.maximum(np.asarray(src_lengths), np.asarray(trg_lengths)).astype(np.int64)
+        self.max_tokens = max_tokens
+        self.bucket_width = bucket_width
+
+    def _batches(self, epoch):
+        rng = np.random.default_rng(self.seed + epoch)
+        order = rng.permutation(len(self.lengths)) if self.shuffle else np.arange(len(self.lengths))
+        ## stable sort keeps the random order inside a bucket
+        order = order[np.argsort(self.lengths[order] // self.bucket_width, kind='stable')]
+
+        batches = []
+        batch, batch_maxlen = [], 0
+        for index, length in zip(order.tolist(), self.lengths[order].tolist()):
+            maxlen = max(batch_maxlen, length)
+            if batch and maxlen * (len(batch) + 1) > self.max_tokens:
+                batches.append(batch)
+                batch, maxlen = [], length
+            batch.append(index)
+            batch_maxlen = maxlen
+        if batch: batches.append(batch)
+
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        return batches
+
+
 ## Collator
 class MyCollate():
-    def __init__(self, pad_value, batch_first=True):
+    """
+    Pads a list of (source, target) token tensors into a batch.
+
+    Each side is written into its (B, T) buffer with a single masked assignment, and the lengths and
+    pad masks are computed once here so the models don't recompute them on the device.
+    With pin_memory=True and no DataLoader workers the buffers are allocated in pinned memory,
+    so the DataLoader pinning step finds them already pinned and does not copy them again
+    (inside workers pinning is left to the DataLoader, CUDA is not available there).
+
+    Returns:
+        Tuple[torch.Tensor, torch.Tensor, dict]: source (B, Ts), target (B, Tt) and
+            {'source_lengths', 'target_lengths' (CPU int64), 'src_pad_mask', 'trg_pad_mask' (bool, True at <pad>)}.
+    """
+    def __init__(self, pad_value, batch_first=True, pin_memory=False):
+        assert batch_first, "Only batch_first batches are supported."
         self.pad_value = pad_value
         self.batch_first = batch_first
+        self.pin_memory = pin_memory
 
     def __call__(self, data):
-        src_stentences = [ex[0] for ex in data]
-        trg_stentences_forward = [ex[1] for ex in data]
-        # trg_stentences_loss = [ex[2] for ex in data]
-
-        padded_src_stentences = pad_sequence(src_stentences, batch_first=self.batch_first,
-                                                      padding_value=self.pad_value)
-        padded_trg_stentences_forward = pad_sequence(trg_stentences_forward, batch_first=self.batch_first,
-                                                      padding_value=self.pad_value)
-        # padded_trg_stentences_loss = pad_sequence(trg_stentences_loss, batch_first=self.batch_first,
-        #                                               padding_value=self.pad_value)
-        return padded_src_stentences, padded_trg_stentences_forward#, padded_trg_stentences_loss
+        source_lengths = torch.tensor([len(ex[0]) for ex in data], dtype=torch.long)
+        target_lengths = torch.tensor([len(ex[1]) for ex in data], dtype=torch.long)
+        Ts, Tt = int(source_lengths.max()), int(target_lengths.max())
+
+        pin = self.pin_memory and get_worker_info() is None and torch.cuda.is_available()
+        padded_src_stentences = torch.full((len(data), Ts), self.pad_value, dtype=torch.long, pin_memory=pin)
+        padded_trg_stentences_forward = torch.full((len(data), Tt), self.pad_value, dtype=torch.long, pin_memory=pin)
+        src_pad_mask = torch.empty((len(data), Ts), dtype=torch.bool, pin_memory=pin)
+        trg_pad_mask = torch.empty((len(data), Tt), dtype=torch.bool, pin_memory=pin)
+
+        torch.ge(torch.arange(Ts), source_lengths.unsqueeze(1), out=src_pad_mask)
+        torch.ge(torch.arange(Tt), target_lengths.unsqueeze(1), out=trg_pad_mask)
+        padded_src_stentences[~src_pad_mask] = torch.cat([ex[0] for ex in data])
+        padded_trg_stentences_forward[~trg_pad_mask] = torch.cat([ex[1] for ex in data])
+
+        batch_info = {'source_lengths': source_lengths, 'target_lengths': target_lengths,
+                      'src_pad_mask': src_pad_mask, 'trg_pad_mask': trg_pad_mask}
+        return padded_src_stentences, padded_trg_stentences_forward, batch_info
     
 
 def get_parameters_info(model):
@@ -84,7 +416,9 @@ def get_parameters_info(model):
 
 
 def plot_history(history, test_history, save_plots_dir, model_type):
-    fig, axes = plt.subplots(2, 2, figsize=(12, 8), gridspec_kw={'width_ratios': [3, 1]})
+    ## a third row of throughput / step-time breakdown when the run logged TrainingMeter records
+    num_rows = 3 if history.get('log_steps') else 2
+    fig, axes = plt.subplots(num_rows, 2, figsize=(12, 4 * num_rows), gridspec_kw={'width_ratios': [3, 1]})
 
     # Plot Losses
     axes[0, 0].plot(history['steps'], history['train_loss'], label="Training Loss")
@@ -97,6 +431,8 @@ def plot_history(history, test_history, save_plots_dir, model_type):
     # Plot Accuracy and BLEU
     axes[1, 0].plot(history['steps'], history['valid_accuracy'], label="Validation Accuracy", color='blue')
     axes[1, 0].plot(history['steps'], history['valid_bleu'], label="Validation BLEU", color='orange')
+    if history.get('valid_decode_bleu'):
+        axes[1, 0].plot(history['steps'], history['valid_decode_bleu'], label="Validation decoded BLEU", color='red')
     axes[1, 0].set_xlabel("Step")
     axes[1, 0].set_ylabel("Scores")
     axes[1, 0].legend()
@@ -112,7 +448,8 @@ def plot_history(history, test_history, save_plots_dir, model_type):
         # Bar plot for test accuracy & BLEU
         bars2 = axes[1, 1].bar(["Test Acc"], [test_history["test_accuracy"]], color='blue', alpha=0.7)
         bars3 = axes[1, 1].bar(["Test BLEU"], [test_history["test_bleu"]], color='orange', alpha=0.7)
-        axes[1, 1].set_ylim(0, max(history['valid_accuracy'] + history['valid_bleu'] + [test_history["test_accuracy"], test_history["test_bleu"]]) * 1.1)
+        axes[1, 1].set_ylim(0, max(history['valid_accuracy'] + history['valid_bleu'] + history.get('valid_decode_bleu', []) +
+                                   [test_history["test_accuracy"], test_history["test_bleu"], test_history.get("test_decode_bleu", 0)]) * 1.1)
 
         # Add text labels above bars
         def add_bar_labels(bars, ax):
@@ -123,6 +460,24 @@ def plot_history(history, test_history, save_plots_dir, model_type):
         add_bar_labels(bars1, axes[0, 1])
         add_bar_labels(bars2, axes[1, 1])
         add_bar_labels(bars3, axes[1, 1])
+        if "test_decode_bleu" in test_history:
+            add_bar_labels(axes[1, 1].bar(["Test decoded BLEU"], [test_history["test_decode_bleu"]], color='red', alpha=0.7), axes[1, 1])
+
+    if num_rows == 3:
+        # Plot throughput
+        axes[2, 0].plot(history['log_steps'], history['tokens_per_sec'], label="Tokens / sec", color='purple')
+        axes[2, 0].set_xlabel("Step")
+        axes[2, 0].set_ylabel("Tokens / sec")
+        axes[2, 0].legend()
+        axes[2, 0].set_title("Training Throughput")
+
+        # Mean time per step phase: a large data bar means the run is input-bound
+        phases = ['data_ms', 'forward_ms', 'backward_ms', 'optimizer_ms']
+        phase_ms = [np.mean(history[phase]) for phase in phases]
+        axes[2, 1].bar([phase[:-len('_ms')] for phase in phases], phase_ms, color=['gray', 'blue', 'orange', 'green'], alpha=0.7)
+        axes[2, 1].tick_params(axis='x', labelrotation=30)
+        axes[2, 1].set_ylabel("ms / step")
+        axes[2, 1].set_title("Step Time Breakdown")
 
     plt.tight_layout()  # Adjust layout to prevent overlap
 
@@ -131,37 +486,299 @@ def plot_history(history, test_history, save_plots_dir, model_type):
     plt.close(fig)
 
 
-def save_checkpoint(model:torch.nn.Module, optimizer, save_dir:str, run_name:str, in_onnx=False):
-    model_path = os.path.join(save_dir, f"{run_name}")
-    if in_onnx:
-        ## onnx
-        model_path = model_path+'.onnx'
-        print("Saving in Onnx format not supported for now.")
+def cpu_snapshot(obj):
+    ## detached CPU copies of every tensor: the training loop keeps updating the originals while the copy is written
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        snapshot = type(obj)((key, cpu_snapshot(value)) for key, value in obj.items())
+        if hasattr(obj, '_metadata'): snapshot._metadata = obj._metadata # state_dict versions
+        return snapshot
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(cpu_snapshot(value) for value in obj)
+    return obj
+
+
+def _atomic_save(state:dict, path:str):
+    ## a crash while writing leaves the previous file untouched
+    tmp_path = path + '.tmp'
+    torch.save(state, tmp_path)
+    os.replace(tmp_path, path)
+
+
+class CheckpointWriter():
+    """
+    Writes checkpoints from a background thread.
+
+    Only the CPU snapshot of the state is taken on the training thread, the serialization happens on the writer thread
+    (to <path>.tmp, then renamed). At most one write is in flight: a new save first waits for the previous one,
+    and an error of a write is raised by the next save / wait.
+
+    Args:
+        keep_last (int): Number of rotated checkpoints kept per rotate_glob, 0 keeps all of them. Default is 3.
+    """
+    def __init__(self, keep_last=3):
+        assert keep_last >= 0, "keep_last must be a non-negative integer."
+        self.keep_last = keep_last
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = None
+
+    def _write(self, state, path, rotate_glob):
+        _atomic_save(state, path)
+        if rotate_glob is not None and self.keep_last > 0:
+            ## zero-padded step numbers: name order is step order
+            for old_path in sorted(glob.glob(rotate_glob))[:-self.keep_last]:
+                os.remove(old_path)
+
+    def save(self, state:dict, path:str, rotate_glob=None):
+        self.wait()
+        self.pending = self.executor.submit(self._write, state, path, rotate_glob)
+
+    def wait(self):
+        if self.pending is not None:
+            pending, self.pending = self.pending, None
+            pending.result()
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown()
+
+
+def get_rng_states():
+    return {'torch': torch.get_rng_state(),
+            'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else [],
+            'python': random.getstate(),
+            ## as lists, loadable with weights_only=True
+            'numpy': [value.tolist() if isinstance(value, np.ndarray) else value for value in np.random.get_state()]}
+
+
+def set_rng_states(rng_states:dict):
+    torch.set_rng_state(rng_states['torch'])
+    if torch.cuda.is_available() and len(rng_states['cuda']) == torch.cuda.device_count():
+        torch.cuda.set_rng_state_all(rng_states['cuda'])
+    random.setstate(tuple(value if not isinstance(value, list) else tuple(value) for value in rng_states['python']))
+    name, keys, pos, has_gauss, cached_gaussian = rng_states['numpy']
+    np.random.set_state((name, np.array(keys, dtype=np.uint32), pos, has_gauss, cached_gaussian))
+
+
+def save_checkpoint(model:torch.nn.Module, optimizer, save_dir:str, run_name:str, in_onnx=False, pad_tokenId=0,
+                    training_state=None, writer:CheckpointWriter=None, rotate_glob=None):
+    """
+    Save model as <save_dir>/<run_name>.pth, and also as ONNX graphs with in_onnx.
+
+    The .pth file holds model_state_dict, optimizer_state_dict (given an optimizer) and the entries of training_state,
+    so a run can resume from it (see Trainer.train(resume_from=...)). With a writer it is written in the background
+    from a CPU snapshot, rotate_glob selects the files rotated by the writer.
+    """
+    ## pytorch, always written: the ONNX graphs can not be resumed from or quantized
+    model_path = os.path.join(save_dir, f"{run_name}.pth")
+    model = getattr(model, '_orig_mod', model) # unwrap torch.compile
+    state = {'model_state_dict': model.state_dict()}
+    if optimizer is not None: state['optimizer_state_dict'] = optimizer.state_dict()
+    state.update(training_state or {})
+    state = cpu_snapshot(state)
+    if writer is None:
+        _atomic_save(state, model_path)
     else:
-        ## pytorch
-        model_path = model_path+'.pth'
-        torch.save({'model_state_dict': model.state_dict()}, model_path)
+        writer.save(state, model_path, rotate_glob)
+    if in_onnx:
+        ## onnx: encoder graph + single decoder-step graph alongside the .pth (see Models/OnnxExport.py)
+        encoder_path, decoder_path = export_onnx(model, save_dir, run_name, pad_tokenId)
+        model_path = f"{model_path}, {encoder_path}, {decoder_path}"
     print(f"Checkpoint saved at: {model_path}")
 
 
+## Metrics
+class CorpusMetrics():
+    """
+    Corpus BLEU and token accuracy of teacher-forced predictions, accumulated batch by batch with tensor ops.
+
+    The n-grams of references and candidates are hashed to int64 ids (tokens as digits in base max token id + 1),
+    the (row, n-gram) keys of each side are counted with torch.unique + bincount, one pass per order, and the clipped
+    matches min(candidate count, reference count) are summed into corpus statistics kept on the device.
+    The candidate of a row is cut at the length of its reference (positions of ignore_index are skipped).
+    BLEU uses the method2 smoothing of NLTK (+1 on the 2..max_order-gram precisions): it equals nltk corpus_bleu
+    on the same tokens. Accuracy is the fraction of non-pad positions where the candidate token is the reference token.
+
+    Args:
+        ignore_index (int): Padding token id of the references.
+        max_order (int): Largest n-gram order of BLEU. Default is 4.
+    """
+    def __init__(self, ignore_index:int, max_order=4):
+        self.ignore_index = ignore_index
+        self.max_order = max_order
+        self.reset()
+
+    def reset(self):
+        self.matches = [0] * self.max_order  # clipped n-gram matches, per order
+        self.possible = [0] * self.max_order # candidate n-grams (at least 1 per sentence), per order
+        self.correct = 0                     # positions where candidate == reference
+        self.num_tokens = 0                  # non-pad reference tokens (= candidate tokens)
+
+    @staticmethod
+    def _ngram_ids(tokens:torch.Tensor, n:int, base:int):
+        windows = tokens.unfold(1, n, 1) # (B, T-n+1, n)
+        if base ** n < 2 ** 63:
+            powers = base ** torch.arange(n - 1, -1, -1, device=tokens.device)
+            return (windows * powers).sum(-1)
+        ## would overflow int64: ids of the distinct n-grams instead
+        return torch.unique(windows.reshape(-1, n), dim=0, return_inverse=True)[1].view(windows.shape[:2])
+
+    def update(self, references:torch.Tensor, candidates:torch.Tensor):
+        ## references, candidates: (B, T) token ids
+        B, T = references.shape
+        mask = references != self.ignore_index
+        lengths = mask.sum(1)
+        self.correct = self.correct + ((candidates == references) & mask).sum()
+        self.num_tokens = self.num_tokens + lengths.sum()
+
+        ## references rows 0..B-1, candidates rows B..2B-1 hashed together so their ids are comparable
+        tokens = torch.cat([references, candidates]).long()
+        base = int(tokens.max()) + 1
+        rows = torch.arange(B, device=tokens.device).repeat(2)
+        is_candidate = torch.arange(2 * B, device=tokens.device) >= B
+        for n in range(1, self.max_order + 1):
+            ## as nltk corpus_bleu, every sentence counts at least one n-gram of each order
+            self.possible[n-1] = self.possible[n-1] + (lengths - n + 1).clamp(min=1).sum()
+            if n > T: continue
+            valid = torch.arange(T - n + 1, device=tokens.device) < (lengths - n + 1).repeat(2).unsqueeze(1)
+            ids = self._ngram_ids(tokens, n, base)[valid]
+            ## key of (row, n-gram): compact n-gram id * B + row, counted per side
+            _, ids = torch.unique(ids, return_inverse=True)
+            keys = ids * B + rows.unsqueeze(1).expand_as(valid)[valid]
+            from_candidate = is_candidate.unsqueeze(1).expand_as(valid)[valid]
+            _, inverse = torch.unique(keys, return_inverse=True)
+            num_keys = int(inverse.max()) + 1 if len(inverse) else 0
+            reference_counts = torch.bincount(inverse[~from_candidate], minlength=num_keys)
+            candidate_counts = torch.bincount(inverse[from_candidate], minlength=num_keys)
+            self.matches[n-1] = self.matches[n-1] + torch.minimum(reference_counts, candidate_counts).sum()
+        return self
+
+    def compute(self):
+        matches = [int(value) for value in self.matches]
+        possible = [int(value) for value in self.possible]
+        num_tokens = int(self.num_tokens)
+        accuracy = int(self.correct) / num_tokens if num_tokens else 0.0
+        if matches[0] == 0:
+            return {"accuracy": accuracy, "bleu": 0.0}
+        precisions = [matches[0] / possible[0]] + [(m + 1) / (p + 1) for m, p in zip(matches[1:], possible[1:])]
+        ## candidates have the length of their references: the brevity penalty is 1
+        bleu = math.exp(sum(math.log(p) for p in precisions) / self.max_order)
+        return {"accuracy": accuracy, "bleu": bleu}
+
+
 def compute_metrics(references:torch.Tensor, candidates:torch.Tensor, ignore_index:int):
-    batch_size = candidates.size(0)
-    total_bleu = 0
-    total_accu = 0
-    smoothing = SmoothingFunction().method2  # Use smoothing to handle zero n-gram overlaps
-    for i in range(batch_size):
-        mask_i = references[i]!=ignore_index
-        candidate = candidates[i][mask_i].tolist()
-        references_one = [references[i][mask_i].tolist()]
-        bleu_score = sentence_bleu(references_one, candidate, weights=[0.25,0.25,0.25,0.25], smoothing_function=smoothing)
-        accu_score = sentence_bleu(references_one, candidate, weights=[1.0,0.0,0.0,0.0], smoothing_function=smoothing)
-        total_bleu += bleu_score
-        total_accu += accu_score
-    bleu = total_bleu / batch_size
-    accuracy = total_accu / batch_size
-    # accuracy = accuracy_score(references.cpu().reshape(-1), candidates.cpu().reshape(-1))
-    
-    return  {"accuracy": accuracy, "bleu": bleu}
+    ## metrics of a single batch, see CorpusMetrics
+    return CorpusMetrics(ignore_index).update(references, candidates).compute()
+
+
+## Training instrumentation
+class TrainingMeter():
+    """
+    Step-time and throughput statistics of the training loop over a logging interval.
+
+    The data wait (time blocked on the DataLoader and issuing the host to device copies) is host time.
+    The forward / backward / optimizer phases are timed with CUDA events on a GPU, read only when the
+    interval is collected, and with perf_counter on CPU. The loss is summed on the device, so collect()
+    is the only synchronization of the interval.
+
+    Args:
+        device (str): Training device.
+    """
+    PHASES = ('forward', 'backward', 'optimizer')
+
+    def __init__(self, device:str):
+        self.device = torch.device(device)
+        self.use_cuda = self.device.type == 'cuda'
+        self.reset()
+
+    def reset(self):
+        self.num_steps = 0
+        self.loss_sum = 0.0
+        self.data_time = 0.0
+        self.step_marks = []
+        self.marks = []
+        self.src_tokens = self.trg_tokens = self.padded_tokens = self.num_examples = 0
+        self.paused = 0.0
+        self.start_time = time.perf_counter()
+        if self.use_cuda: torch.cuda.reset_peak_memory_stats(self.device)
+
+    def start_data(self):
+        self.data_start = time.perf_counter()
+
+    def end_data(self, data:torch.Tensor, labels_forward:torch.Tensor, batch_info:dict):
+        self.data_time += time.perf_counter() - self.data_start
+        ## lengths are CPU tensors
+        self.src_tokens += int(batch_info['source_lengths'].sum())
+        self.trg_tokens += int(batch_info['target_lengths'].sum())
+        self.padded_tokens += data.numel() + labels_forward.numel()
+        self.num_examples += data.size(0)
+
+    def mark(self):
+        ## boundary of a phase: start of forward, end of forward / backward / optimizer
+        if self.use_cuda:
+            event = torch.cuda.Event(enable_timing=True)
+            event.record()
+            self.step_marks.append(event)
+        else:
+            self.step_marks.append(time.perf_counter())
+
+    def end_step(self, loss:torch.Tensor):
+        self.loss_sum = self.loss_sum + loss.detach().float()
+        self.marks.append(self.step_marks)
+        self.step_marks = []
+        self.num_steps += 1
+
+    def pause(self):
+        ## excludes evaluation / checkpointing from the interval wall time
+        self.pause_start = time.perf_counter()
+
+    def resume(self):
+        self.paused += time.perf_counter() - self.pause_start
+
+    def collect(self, step:int, lr:float):
+        """
+        Returns:
+            dict: Per-step means of the interval (times in ms), throughput and peak memory, then starts a new interval.
+        """
+        train_loss = float(self.loss_sum) / max(self.num_steps, 1) # synchronizes
+        wall_time = max(time.perf_counter() - self.start_time - self.paused, 1e-9)
+        phase_times = dict.fromkeys(self.PHASES, 0.0)
+        for marks in self.marks:
+            for phase, start, end in zip(self.PHASES, marks[:-1], marks[1:]):
+                phase_times[phase] += start.elapsed_time(end) / 1000 if self.use_cuda else end - start
+        if self.use_cuda:
+            peak_memory = torch.cuda.max_memory_allocated(self.device)
+        else:
+            peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 # process peak RSS (KB on Linux)
+        num_steps = max(self.num_steps, 1)
+        record = {'step': step, 'lr': lr, 'train_loss': round(train_loss, 4),
+                  'tokens_per_sec': round((self.src_tokens + self.trg_tokens) / wall_time, 1),
+                  'src_tokens_per_sec': round(self.src_tokens / wall_time, 1),
+                  'trg_tokens_per_sec': round(self.trg_tokens / wall_time, 1),
+                  'examples_per_sec': round(self.num_examples / wall_time, 1),
+                  'padding_ratio': round(1 - (self.src_tokens + self.trg_tokens) / max(self.padded_tokens, 1), 4),
+                  'step_ms': round(wall_time / num_steps * 1000, 2),
+                  'data_ms': round(self.data_time / num_steps * 1000, 2),
+                  **{f'{phase}_ms': round(phase_times[phase] / num_steps * 1000, 2) for phase in self.PHASES},
+                  'data_wait_ratio': round(self.data_time / wall_time, 4),
+                  'peak_memory_mb': round(peak_memory / 2**20, 1)}
+        self.reset()
+        return record
+
+
+class JsonlLogger():
+    ## one JSON record per line, flushed at every record so the file can be followed during training
+    def __init__(self, path:str, append=False):
+        self.path = path
+        self.file = open(path, 'a' if append else 'w')
+
+    def log(self, record:dict):
+        self.file.write(json.dumps(record) + '\n')
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
 
 
 class CosineScheduler():
@@ -190,13 +807,100 @@ def greedy_decode(model:torch.nn.Module, source_tensor:torch.Tensor, sos_tokenId
     device = source_tensor.device
     target_tensor = torch.tensor([sos_tokenId]).unsqueeze(0).to(device)
 
+    # Encode once, then feed only the newest token to the decoder
+    state = model.encode(source_tensor, pad_tokenId)
     for i in range(max_tries):
-        logits, _ = model(source_tensor, target_tensor, pad_tokenId)
+        logits, state = model.decode_step(state, target_tensor[:, -1:])
         # Greedy decoding
-        top1 = logits[:,-1,:].argmax(dim=-1, keepdim=True)
+        top1 = logits.argmax(dim=-1, keepdim=True)
         # Append predicted token
         target_tensor = torch.cat([target_tensor, top1], dim=1)
         # Stop if predict <EOS>
         if top1.item() == eos_tokenId:
             break
-    return target_tensor.squeeze(0).tolist()
\ No newline at end of file
+    return target_tensor.squeeze(0).tolist()
+
+@torch.no_grad
+def greedy_decode_batch(model:torch.nn.Module, source_tensor:torch.Tensor, sos_tokenId: int, eos_tokenId:int, pad_tokenId, max_tries=50):
+    ## source_tensor: padded batch of shape (B, Ts)
+    ## returns one token list per row (<s> ... </s>) with the padding stripped
+    model.eval()
+    B = source_tensor.size(0)
+    device = source_tensor.device
+    state = model.encode(source_tensor, pad_tokenId)
+    step_tokens = torch.full((B, 1), sos_tokenId, dtype=torch.long, device=device)
+    targets_hat = [step_tokens]
+    finished = torch.zeros(B, dtype=torch.bool, device=device)
+    lengths = torch.full((B,), max_tries+1, dtype=torch.long, device=device)
+    for step in range(max_tries):
+        logits, state = model.decode_step(state, step_tokens)
+        ## rows that already emitted </s> keep emitting <pad>
+        step_tokens = logits.argmax(-1, keepdim=True).masked_fill(finished.unsqueeze(1), pad_tokenId)
+        targets_hat.append(step_tokens)
+        just_finished = ~finished & (step_tokens.squeeze(1) == eos_tokenId)
+        lengths = lengths.masked_fill(just_finished, step+2)
+        finished = finished | just_finished
+        if finished.all():
+            break
+    targets_hat = torch.cat(targets_hat, dim=1).tolist()
+    return [row[:length] for row, length in zip(targets_hat, lengths.tolist())]
+
+@torch.no_grad
+def beam_search(model:torch.nn.Module, source_tensor:torch.Tensor, sos_tokenId: int, eos_tokenId:int, pad_tokenId,
+                beam_size=4, max_tries=50, length_penalty=1.0, early_stopping=True):
+    ## source_tensor: padded batch of shape (B, Ts)
+    ## Beams are kept as extra batch rows (B*beam_size) and the encoder runs once per sentence.
+    ## Hypotheses are ranked by score / length**length_penalty. Finished beams are frozen (they only
+    ## extend with <pad> at zero cost). A sentence stops when its best beam has finished (early_stopping)
+    ## or when all of its beams have finished.
+    ## returns the best token list per sentence (<s> ... </s>)
+    model.eval()
+    B = source_tensor.size(0)
+    K = beam_size
+    device = source_tensor.device
+
+    state = model.encode(source_tensor, pad_tokenId)
+    state = model.reorder_state(state, torch.arange(B, device=device).repeat_interleave(K))
+
+    step_tokens = torch.full((B*K, 1), sos_tokenId, dtype=torch.long, device=device)
+    targets_hat = step_tokens
+    ## only the first beam of each sentence is alive at the start, the others are copies of it
+    scores = torch.zeros(B, K, device=device)
+    scores[:, 1:] = float('-inf')
+    scores = scores.view(-1)
+    lengths = torch.zeros(B*K, dtype=torch.long, device=device)
+    finished = torch.zeros(B*K, dtype=torch.bool, device=device)
+    beam_offsets = (torch.arange(B, device=device) * K).unsqueeze(1) # (B, 1)
+
+    for step in range(max_tries):
+        logits, state = model.decode_step(state, step_tokens)
+        log_probs = torch.log_softmax(logits.float(), dim=-1) # (B*K, V)
+        V = log_probs.size(-1)
+        ## finished beams can only be extended with <pad>, keeping their score unchanged
+        pad_log_probs = torch.where(finished, 0.0, log_probs[:, pad_tokenId])
+        log_probs = log_probs.masked_fill(finished.unsqueeze(1), float('-inf'))
+        log_probs[:, pad_tokenId] = pad_log_probs
+
+        candidate_scores = scores.unsqueeze(1) + log_probs # (B*K, V)
+        candidate_lengths = lengths + (~finished).long()
+        normalized = candidate_scores / candidate_lengths.float().pow(length_penalty).unsqueeze(1)
+        _, top_idx = normalized.view(B, K*V).topk(K, dim=-1) # (B, K)
+
+        rows = (beam_offsets + top_idx // V).view(-1)
+        step_tokens = (top_idx % V).view(-1, 1)
+        scores = candidate_scores.view(B, K*V).gather(1, top_idx).view(-1)
+        lengths = candidate_lengths.index_select(0, rows)
+        finished = finished.index_select(0, rows) | (step_tokens.squeeze(1) == eos_tokenId)
+        targets_hat = torch.cat([targets_hat.index_select(0, rows), step_tokens], dim=1)
+        state = model.reorder_state(state, rows)
+
+        ## top_idx is sorted, so beam 0 of each sentence is its current best hypothesis
+        if early_stopping: done = finished.view(B, K)[:, 0]
+        else: done = finished.view(B, K).all(dim=-1)
+        if done.all():
+            break
+        ## freeze sentences that are done so their best beam can not be overtaken
+        finished = finished | done.repeat_interleave(K)
+
+    best = targets_hat.view(B, K, -1)[:, 0].tolist()
+    return [row[:length+1] for row, length in zip(best, lengths.view(B, K)[:, 0].tolist())]
@@ -1,4 +1,3 @@
-import pandas as pd
 from Models.AutoModel import get_model
 from Training.Trainer import Trainer
 from Training.TrainingArguments import TrainingArguments
@@ -8,16 +7,16 @@ import os
 import argparse
 import sys
 from torch.utils.data import DataLoader
-from utils import MT_Dataset, MyCollate, compute_metrics, get_parameters_info, plot_history
+from utils import MT_TokenCacheDataset, MT_StreamingDataset, build_token_cache, MyCollate, CorpusMetrics, get_parameters_info, plot_history
 
 
 # Command-Line Arguments
 def parse_arguments():
     parser = argparse.ArgumentParser(description='Argument Parser for Your Program')
 
-    parser.add_argument('--train_csv_path', type=str, required=True, help='CSV of columns for train')
-    parser.add_argument('--valid_csv_path', type=str, required=True, help='CSV of columns for validation')
-    parser.add_argument('--test_csv_path', default='None', type=str, required=False, help='CSV of columns for Testing')
+    parser.add_argument('--train_csv_path', type=str, required=True, help='CSV (or Parquet file / directory of Parquet shards) of columns for train')
+    parser.add_argument('--valid_csv_path', type=str, required=True, help='CSV (or Parquet file / directory of Parquet shards) of columns for validation')
+    parser.add_argument('--test_csv_path', default='None', type=str, required=False, help='CSV (or Parquet file / directory of Parquet shards) of columns for Testing')
     parser.add_argument('--source_column_name', type=str, required=True, help='source_column_name')
     parser.add_argument('--target_column_name', type=str, required=True, help='target_column_name')
     parser.add_argument('--tokenizer_path', type=str, required=True, help='A path of tokenizer.model')
@@ -26,6 +25,14 @@ def parse_arguments():
     parser.add_argument('--out_dir', type=str, required=True, help='A path for output directory')
     parser.add_argument('--model_type', type=str, required=True, choices=['s2s', 's2sAttention', 'transformer'],
                     help='A type of model (choices: s2s, s2sAttention, transformer)')
+    parser.add_argument('--token_cache_dir', default='None', type=str, required=False,
+                        help='Directory of the pre-tokenized datasets (default: out_dir/token_cache)')
+    parser.add_argument('--streaming', action='store_true',
+                        help='Stream the train csv in chunks instead of loading/caching it (corpora larger than RAM)')
+    parser.add_argument('--shuffle_buffer_size', default=100_000, type=int, required=False,
+                        help='Shuffle buffer size (pairs per DataLoader worker) of the streaming train dataset')
+    parser.add_argument('--resume_from', default='None', type=str, required=False,
+                        help="Checkpoint .pth to resume training from, or 'latest' for the last one of out_dir/models/checkpoints")
     
     return parser
  
@@ -49,6 +56,10 @@ if __name__ == '__main__':
         test_csv_path = None
 
     os.makedirs(args.out_dir, exist_ok=True)
+    token_cache_dir = args.token_cache_dir
+    if token_cache_dir == 'None':
+        token_cache_dir = os.path.join(args.out_dir, 'token_cache')
+    os.makedirs(token_cache_dir, exist_ok=True)
 
     print("---------------------Starting Tokenizer Loading...---------------------")
     tokenizer = Callable_tokenizer(args.tokenizer_path)
@@ -57,23 +68,25 @@ if __name__ == '__main__':
     print("Tokenizer Loading Done.")
 
     print("---------------------Starting Data Loading...---------------------")
-    train_df = pd.read_csv(args.train_csv_path)
-    valid_df = pd.read_csv(args.valid_csv_path)
-
-    train_ds = MT_Dataset(input_sentences_list=train_df[args.source_column_name].to_list(),
-                            target_sentences_list=train_df[args.target_column_name].to_list(),
-                            callable_tokenizer=tokenizer)
+    ## tokenized once into memory-mapped arrays, later runs reuse the cache
+    if args.streaming:
+        ## constant memory: chunked reads, rows sharded across workers, bounded shuffle buffer
+        train_ds = MT_StreamingDataset(args.train_csv_path, args.source_column_name, args.target_column_name,
+                                       tokenizer, shuffle_buffer_size=args.shuffle_buffer_size)
+    else:
+        train_ds = MT_TokenCacheDataset(build_token_cache(args.train_csv_path, args.source_column_name, args.target_column_name,
+                                                          tokenizer, token_cache_dir))
 
-    valid_ds = MT_Dataset(input_sentences_list=valid_df[args.source_column_name].to_list(),
-                            target_sentences_list=valid_df[args.target_column_name].to_list(),
-                            callable_tokenizer=tokenizer)
+    valid_ds = MT_TokenCacheDataset(build_token_cache(args.valid_csv_path, args.source_column_name, args.target_column_name,
+                                                      tokenizer, token_cache_dir))
 
-    mycollate = MyCollate(batch_first=True,
-                            pad_value=tokenizer.get_tokenId('<pad>'))
 
-    print(f"Training data length {len(train_ds):,}, Validation data length {len(valid_ds):,}")
-    print(f"Source tokens: {train_ds[0][0]}")
-    print(f"Target tokens: {train_ds[0][1]}")
+    if args.streaming:
+        print(f"Training data streamed from {args.train_csv_path}, Validation data length {len(valid_ds):,}")
+    else:
+        print(f"Training data length {len(train_ds):,}, Validation data length {len(valid_ds):,}")
+    print(f"Source tokens: {valid_ds[0][0]}")
+    print(f"Target tokens: {valid_ds[0][1]}")
     # print(f"Target_loss tokens: {train_ds[0][2]}")
     print("Data Loading Done.")
 
@@ -93,23 +106,25 @@ if __name__ == '__main__':
     print("---------------------Parsing Training arguments...---------------------")
     training_args = TrainingArguments(args.out_dir, args.training_config_path)
     print(training_args)
+    mycollate = MyCollate(batch_first=True,
+                            pad_value=tokenizer.pad_tokenId,
+                            pin_memory=training_args.pin_memory)
     print("Parsing Done.")
 
     print("---------------------Start training...---------------------")
     trainer = Trainer(args=training_args, model=model,
                         train_ds=train_ds, valid_ds=valid_ds,
-                        collator=mycollate, compute_metrics_func=compute_metrics)
+                        collator=mycollate, compute_metrics_func=CorpusMetrics,
+                        tokenizer=tokenizer)
 
-    history = trainer.train()
+    history = trainer.train(resume_from=None if args.resume_from == 'None' else args.resume_from)
     print(f"Training Done.")
 
     test_metrics=None
     if test_csv_path is not None:
         print("---------------------Start evaluation on test-set...---------------------")
-        test_df = pd.read_csv(test_csv_path)
-        test_ds = MT_Dataset(input_sentences_list=test_df[args.source_column_name].to_list(),
-                            target_sentences_list=test_df[args.target_column_name].to_list(),
-                            callable_tokenizer=tokenizer)
+        test_ds = MT_TokenCacheDataset(build_token_cache(test_csv_path, args.source_column_name, args.target_column_name,
+                                                         tokenizer, token_cache_dir))
 
         test_loader = DataLoader(test_ds,
                                 batch_size=training_args.batch_size,